@@ -0,0 +1,313 @@
+"""
+Benchmarks for the SiSh Tracker hot paths.
+
+Builds a synthetic ledger in a temporary database, times the loaders, searches,
+totals, CSV export and insert paths of port-3.py, and writes the results as JSON.
+
+    python benchmark.py --scale 1m --output bench.json
+    python benchmark.py --scale 1m --compare bench.json
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+SCALES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000, "10m": 10_000_000}
+GENERATE_CHUNK_SIZE = 50_000
+REGRESSION_THRESHOLD = 1.20  # Flag anything at least 20% slower than the baseline
+NOTE_WORDS = ("coffee", "lunch", "dinner", "groceries", "train", "taxi", "rent", "gift", "books", "cinema",
+              "pharmacy", "bakery", "hardware", "fuel", "parking", "market", "office", "birthday", "holiday",
+              "repair", "subscription", "concert", "museum", "electric", "water", "phone", "insurance")
+NOTE_EVERY = 4  # One generated record in NOTE_EVERY has a note
+RULES = 10_000  # Recurring rules in the materializer benchmark
+
+# port-3.py isn't a valid module name, so load it from its path
+def load_tracker():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "port-3.py")
+    spec = importlib.util.spec_from_file_location("tracker", path)
+    tracker = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = tracker  # So worker processes can unpickle its functions
+    spec.loader.exec_module(tracker)
+    return tracker
+
+# Fill the database with users, categories, expenses and income.
+# Dates only move forward, like a real ledger, so inserts append to the date indexes.
+def generate_ledger(conn: sqlite3.Connection, expense_rows: int, income_rows: int, users: int = 10,
+                    categories: int = 40, seed: int = 42, start: date = date(2015, 1, 1)):
+    rng = random.Random(seed)
+    conn.executemany('INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)',
+                     [(f"user{i}", "x") for i in range(1, users + 1)])
+    conn.executemany('INSERT OR IGNORE INTO expense_categories (category_name) VALUES (?)',
+                     [(f"category {i}",) for i in range(1, categories + 1)])
+    conn.executemany('INSERT OR IGNORE INTO income_categories (category_name) VALUES (?)',
+                     [(name,) for name in ("salary", "freelance", "other")])
+    expense_ids = [row[0] for row in conn.execute('SELECT id FROM expense_categories')]
+    income_ids = [row[0] for row in conn.execute('SELECT id FROM income_categories')]
+    conn.commit()
+
+    for table, rows, category_ids, max_amount in (("expenses", expense_rows, expense_ids, 500),
+                                                   ("income", income_rows, income_ids, 5000)):
+        days = 10 * 365
+        for offset in range(0, rows, GENERATE_CHUNK_SIZE):
+            count = min(GENERATE_CHUNK_SIZE, rows - offset)
+            conn.executemany(
+                f'INSERT INTO {table} (amount, category_id, date, user_id, note) VALUES (?, ?, ?, ?, ?)',
+                [(rng.randint(1, max_amount),
+                  rng.choice(category_ids),
+                  (start + timedelta(days=(offset + i) * days // rows)).toordinal(),  # Dates are stored as day numbers
+                  rng.randint(1, users),
+                  f"{rng.choice(NOTE_WORDS)} {rng.choice(NOTE_WORDS)} #{rng.randint(1, 9999)}"
+                  if rng.randrange(NOTE_EVERY) == 0 else None)
+                 for i in range(count)])
+            conn.commit()
+
+# Write a CSV the importer can read, for timing the bulk insert path
+def write_import_file(path: str, rows: int, seed: int = 7):
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("amount,category,date\n")
+        for i in range(rows):
+            f.write(f"{rng.randint(1, 500)},category {rng.randint(1, 40)},2030-01-{i % 28 + 1:02d}\n")
+
+# Run fn `repeat` times with its output silenced; returns timing stats in milliseconds
+def measure(fn, repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - start) * 1000)
+    return {
+        "repeat": repeat,
+        "min_ms": round(min(timings), 3),
+        "median_ms": round(statistics.median(timings), 3),
+        "max_ms": round(max(timings), 3),
+    }
+
+def run_benchmarks(tracker, rows: int, repeat: int, workdir: str) -> dict:
+    results = {}
+    small = max(1, repeat)
+    once = 1 if rows >= 1_000_000 else small  # Full-table passes are slow enough to time once
+
+    # Category registry load
+    results["load_categories"] = measure(tracker.load_categories, small)
+
+    # Searches
+    results["search_amount"] = measure(lambda: tracker.query_records("expense", amount=250), small)
+    results["search_category"] = measure(lambda: tracker.query_records("expense", category="category 7"), once)
+    results["search_date"] = measure(
+        lambda: tracker.query_records("expense", date_from="2020-06-01", date_to="2020-06-01"), small)
+    results["search_date_range"] = measure(
+        lambda: tracker.query_records("expense", date_from="2020-06-01", date_to="2020-06-30"), small)
+    results["first_page"] = measure(lambda: tracker.fetch_page("expense"), small)
+    results["first_page_newest"] = measure(
+        lambda: tracker.query_records("expense", order="date_desc", limit=tracker.PAGE_SIZE), small)
+    results["first_page_by_category"] = measure(
+        lambda: tracker.query_records("expense", order="category", limit=tracker.PAGE_SIZE), small)
+    results["top20_month"] = measure(
+        lambda: tracker.query_records("expense", date_from="2020-06-01", date_to="2020-06-30",
+                                      order="amount_desc", limit=20), small)
+
+    # Full-text search: a first page of note matches, a rare two-word match, a typo, and a category name
+    results["find_note_prefix"] = measure(lambda: tracker.text_search("expense", "groc"), small)
+    results["find_note_two_words"] = measure(lambda: tracker.text_search("expense", "museum birthday"), small)
+    results["find_note_fuzzy"] = measure(lambda: tracker.text_search("expense", "pharmcy", fuzzy=True), small)
+    results["find_category"] = measure(lambda: tracker.text_search("expense", "category 7"), small)
+
+    # Totals and reports
+    results["totals"] = measure(tracker.get_totals, small)
+    results["totals_check"] = measure(lambda: tracker.check_totals(repair=False), once)
+    results["report_year_by_category"] = measure(
+        lambda: tracker.period_category_totals("expense", "month", date_from="2020-01-01", date_to="2020-12-31"),
+        small)
+
+    # CSV export
+    csv_path = os.path.join(workdir, "export.csv")
+    results["export_csv"] = measure(lambda: tracker.export_csv("expense", csv_path), once)
+
+    # Batch reports for every user and month, with one worker process and with one per CPU
+    tracker.connect_db().commit()  # The workers read through their own connections
+    reports_dir = os.path.join(workdir, "reports")
+    for workers in sorted({1, os.cpu_count() or 1}):
+        results[f"batch_reports_workers{workers}"] = measure(
+            lambda: tracker.run_batch_reports(reports_dir, workers, progress=False, all_users=True), once)
+
+    # Duplicate detection: the generated rows have no content hash yet, so this hashes the whole table
+    results["dedupe_pass"] = measure(lambda: tracker.dedupe_records("expense"), 1)
+
+    # Insert paths (distinct amounts, so none of them is a duplicate)
+    inserts = 1000
+    results["insert_record_x1000"] = measure(
+        lambda: [tracker.insert_record("expense", i, "category 1", "2030-01-01") for i in range(1, inserts + 1)], 1)
+    queued = 10_000
+    results[f"queued_insert_x{queued}"] = measure(
+        lambda: [future.result() for future in
+                 [tracker.queue_insert("expense", i, "category 2", "2030-01-02") for i in range(1, queued + 1)]], 1)
+    import_path = os.path.join(workdir, "import.csv")
+    import_rows = min(rows, 100_000)
+    write_import_file(import_path, import_rows)
+    results[f"import_records_x{import_rows}"] = measure(lambda: tracker.import_records(import_path, "expense"), 1)
+
+    # Recurring records: a year's backlog for 10,000 rules, then the rerun, which finds nothing due
+    cadences = ["monthly", "weekly", "1,15 * *", "yearly"]
+    with tracker.transaction():
+        for i in range(RULES):
+            tracker.add_rule("expense", i % 500 + 1, f"category {i % 40 + 1}", cadences[i % len(cadences)],
+                             "2021-01-01")
+    results[f"materialize_rules_x{RULES}_year"] = measure(lambda: tracker.materialize_rules("2021-12-31"), 1)
+    results[f"materialize_rules_x{RULES}_year"]["records"] = tracker.connect_db().execute(
+        "SELECT COUNT(*) FROM expenses WHERE external_ref LIKE 'rule:%'").fetchone()[0]
+    results["materialize_rules_rerun"] = measure(lambda: tracker.materialize_rules("2021-12-31"), small)
+    return results
+
+# Time starting the program from scratch: a new process running one command. Creating a database
+# runs every migration; opening a current one should only read the schema version.
+def run_startup_benchmarks(tracker, repeat: int, workdir: str) -> dict:
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "port-3.py")
+    paths = iter(range(repeat))
+
+    def start(db_path, *options):
+        subprocess.run([sys.executable, script, "--db", db_path, *options, "report", "totals"],
+                       check=True, stdout=subprocess.DEVNULL)
+    return {
+        "cold_start_new_db": measure(lambda: start(os.path.join(workdir, f"startup-{next(paths)}.db")), repeat),
+        "cold_start": measure(lambda: start(os.path.join(workdir, "startup-0.db")), repeat),
+        "cold_start_read_only": measure(lambda: start(os.path.join(workdir, "startup-0.db"), "--read-only"), repeat),
+        "init_db_current": measure(tracker.init_db, repeat),
+    }
+
+# Time logins one after another versus concurrently through the async auth service
+def run_auth_benchmarks(tracker, logins: int, rounds: int) -> dict:
+    tracker.BCRYPT_ROUNDS = rounds
+    users = [(f"bench{i}", f"password {i}") for i in range(min(logins, 20))]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for username, password in users:
+            tracker.register_user(username, password)
+    attempts = [users[i % len(users)] for i in range(logins)]
+    results = {}
+
+    results[f"auth_sequential_x{logins}"] = measure(
+        lambda: [tracker.authenticate_user(username, password) for username, password in attempts], 1)
+
+    latencies = []
+
+    async def timed_login(username, password):
+        start = time.perf_counter()
+        token = await tracker.authenticate_async(username, password)
+        latencies.append((time.perf_counter() - start) * 1000)
+        return token
+
+    async def concurrent_logins():
+        return await asyncio.gather(*(timed_login(username, password) for username, password in attempts))
+
+    tokens = []
+    results[f"auth_concurrent_x{logins}"] = measure(lambda: tokens.extend(asyncio.run(concurrent_logins())), 1)
+    latencies.sort()
+    results[f"auth_concurrent_x{logins}"].update({
+        "logins_per_second": round(logins / (results[f"auth_concurrent_x{logins}"]["median_ms"] / 1000), 1),
+        "latency_p50_ms": round(latencies[len(latencies) // 2], 3),
+        "latency_p95_ms": round(latencies[int(len(latencies) * 0.95) - 1], 3),
+    })
+    results[f"auth_sequential_x{logins}"]["logins_per_second"] = round(
+        logins / (results[f"auth_sequential_x{logins}"]["median_ms"] / 1000), 1)
+
+    # Repeat operations use the session cache instead of bcrypt
+    lookups = 100_000
+    results[f"session_lookup_x{lookups}"] = measure(
+        lambda: [tracker.session_user(tokens[i % len(tokens)]) for i in range(lookups)], 3)
+    return results
+
+# Print a side-by-side comparison; returns the names of benchmarks that regressed
+def compare(results: dict, baseline: dict) -> list:
+    regressions = []
+    if baseline["meta"]["rows"] != results["meta"]["rows"]:
+        print(f"Warning: baseline has {baseline['meta']['rows']} rows, this run has {results['meta']['rows']}.")
+    print(f"{'benchmark':<32} {'baseline ms':>12} {'current ms':>12} {'ratio':>7}")
+    for name, current in results["benchmarks"].items():
+        previous = baseline["benchmarks"].get(name)
+        if previous is None:
+            print(f"{name:<32} {'-':>12} {current['median_ms']:>12.3f}")
+            continue
+        ratio = current["median_ms"] / previous["median_ms"] if previous["median_ms"] else float("inf")
+        flag = "  REGRESSION" if ratio >= REGRESSION_THRESHOLD else ""
+        print(f"{name:<32} {previous['median_ms']:>12.3f} {current['median_ms']:>12.3f} {ratio:>6.2f}x{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the SiSh Tracker hot paths on a synthetic ledger.")
+    parser.add_argument("--scale", choices=list(SCALES), default="10k", help="number of expense rows")
+    parser.add_argument("--rows", type=int, help="exact number of expense rows (overrides --scale)")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark (default: 5)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the JSON results to this file (default: stdout)")
+    parser.add_argument("--compare", metavar="BASELINE", help="compare against an earlier JSON result")
+    parser.add_argument("--auth-logins", type=int, default=0, metavar="N",
+                        help="also benchmark N sequential vs concurrent bcrypt logins")
+    parser.add_argument("--bcrypt-rounds", type=int, default=12, help="bcrypt cost for the login benchmark")
+    args = parser.parse_args(argv)
+
+    rows = args.rows or SCALES[args.scale]
+    tracker = load_tracker()
+    with tempfile.TemporaryDirectory(prefix="tracker-bench-") as workdir:
+        tracker.DB_PATH = os.path.join(workdir, "bench.db")
+        tracker.init_db()
+        tracker.set_current_user(1)  # Per-user paths run as user1, one of ten users in the ledger
+
+        start = time.perf_counter()
+        generate_ledger(tracker.connect_db(), rows, max(1, rows // 10), seed=args.seed)
+        generate_seconds = time.perf_counter() - start
+
+        results = {
+            "meta": {
+                "rows": rows,
+                "income_rows": max(1, rows // 10),
+                "repeat": args.repeat,
+                "seed": args.seed,
+                "generate_seconds": round(generate_seconds, 3),
+                "python": platform.python_version(),
+                "sqlite": sqlite3.sqlite_version,
+                "platform": platform.platform(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+            "benchmarks": {**run_startup_benchmarks(tracker, args.repeat, workdir),
+                           **run_benchmarks(tracker, rows, args.repeat, workdir)},
+        }
+        if args.auth_logins:
+            results["meta"]["bcrypt_rounds"] = args.bcrypt_rounds
+            results["meta"]["auth_workers"] = tracker.AUTH_WORKERS
+            results["benchmarks"].update(run_auth_benchmarks(tracker, args.auth_logins, args.bcrypt_rounds))
+        tracker.stop_flusher()
+        tracker.close_db()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    elif not args.compare:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) regressed by {REGRESSION_THRESHOLD - 1:.0%} or more.")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
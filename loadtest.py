@@ -0,0 +1,201 @@
+"""
+Load test for the SiSh Tracker HTTP API.
+
+Starts `port-3.py serve` on a synthetic ledger in a temporary database (or targets a
+running server with --url), then runs reader threads flat out alongside writers that
+post records at a steady rate. Prints throughput and latency percentiles for both,
+plus the server's own /metrics.
+
+    python loadtest.py --rows 100000 --readers 16 --writers 2 --write-rate 50 --duration 10
+    python loadtest.py --url http://127.0.0.1:8000 --username alice --password secret
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+from benchmark import generate_ledger, load_tracker
+
+LOADTEST_USER = "user1"
+LOADTEST_PASSWORD = "load test"
+
+# Build a ledger and give user1 a real password, so the test reads a full set of records
+def prepare_database(path: str, rows: int, seed: int):
+    tracker = load_tracker()
+    tracker.DB_PATH = path
+    tracker.BCRYPT_ROUNDS = 4  # The login isn't what we're measuring
+    tracker.init_db()
+    conn = tracker.connect_db()
+    generate_ledger(conn, rows, max(1, rows // 10), seed=seed)
+    conn.execute('UPDATE users SET password_hash = ? WHERE username = ?',
+                 (tracker.hash_password(LOADTEST_PASSWORD), LOADTEST_USER))
+    conn.commit()
+    tracker.close_db()
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(db_path: str, port: int, readers: int) -> subprocess.Popen:
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "port-3.py")
+    server = subprocess.Popen([sys.executable, script, "--db", db_path, "serve",
+                               "--port", str(port), "--readers", str(readers)])
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return server
+        except OSError:
+            time.sleep(0.05)
+    server.terminate()
+    raise RuntimeError("The server didn't start within 10 seconds.")
+
+# One keep-alive connection per worker thread
+class Client:
+    def __init__(self, url: str, token: str = ""):
+        parts = urllib.parse.urlsplit(url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+        self.token = token
+
+    def request(self, method: str, path: str, body: dict = None):
+        headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        self.conn.request(method, path, body=data, headers=headers)
+        response = self.conn.getresponse()
+        payload = response.read()
+        return response.status, json.loads(payload) if payload else None
+
+def login(url: str, username: str, password: str) -> str:
+    status, payload = Client(url).request("POST", "/login", {"username": username, "password": password})
+    if status != 200:
+        raise RuntimeError(f"Login failed: {payload}")
+    return payload["token"]
+
+# Mix of page reads, filtered searches, totals and a report
+def read_requests(rng: random.Random) -> str:
+    choice = rng.random()
+    if choice < 0.5:
+        return f"/records/expense?limit=20&after={rng.randint(0, 1000)}"
+    if choice < 0.8:
+        day = f"2020-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        return f"/records/expense?date={day}"
+    if choice < 0.95:
+        return "/totals"
+    return "/reports/top?kind=expense&limit=5&from=2020-01-01&to=2020-12-31"
+
+def reader(url: str, token: str, stop: threading.Event, latencies: list, errors: list, seed: int):
+    client = Client(url, token)
+    rng = random.Random(seed)
+    while not stop.is_set():
+        start = time.perf_counter()
+        status, _ = client.request("GET", read_requests(rng))
+        latencies.append(time.perf_counter() - start)
+        if status >= 400:
+            errors.append(status)
+
+# Post records at a fixed rate; the schedule doesn't drift when a write runs long
+def writer(url: str, token: str, stop: threading.Event, rate: float, latencies: list, errors: list, seed: int):
+    client = Client(url, token)
+    rng = random.Random(seed)
+    interval = 1 / rate
+    next_write = time.perf_counter()
+    while not stop.is_set():
+        delay = next_write - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        next_write += interval
+        start = time.perf_counter()
+        status, _ = client.request("POST", "/records/expense", {
+            "amount": rng.randint(1, 500), "category": f"category {rng.randint(1, 40)}", "date": "2030-01-01"})
+        latencies.append(time.perf_counter() - start)
+        if status >= 400:
+            errors.append(status)
+
+def summarize(latencies: list, seconds: float) -> dict:
+    latencies = sorted(latencies)
+    if not latencies:
+        return {"requests": 0}
+
+    def pct(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3)
+    return {"requests": len(latencies), "per_second": round(len(latencies) / seconds, 1),
+            "p50_ms": pct(0.50), "p95_ms": pct(0.95), "p99_ms": pct(0.99), "max_ms": round(latencies[-1] * 1000, 3)}
+
+def run(url: str, token: str, readers: int, writers: int, write_rate: float, duration: float) -> dict:
+    stop = threading.Event()
+    read_latencies, write_latencies, read_errors, write_errors = [], [], [], []
+    threads = [threading.Thread(target=reader, args=(url, token, stop, read_latencies, read_errors, i))
+               for i in range(readers)]
+    threads += [threading.Thread(target=writer, args=(url, token, stop, write_rate, write_latencies, write_errors, i))
+                for i in range(writers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    return {
+        "reads": {**summarize(read_latencies, seconds), "errors": len(read_errors)},
+        "writes": {**summarize(write_latencies, seconds), "errors": len(write_errors)},
+        "server": Client(url).request("GET", "/metrics")[1],
+    }
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Load test the SiSh Tracker HTTP API.")
+    parser.add_argument("--url", help="test a running server instead of starting one")
+    parser.add_argument("--username", default=LOADTEST_USER)
+    parser.add_argument("--password", default=LOADTEST_PASSWORD)
+    parser.add_argument("--rows", type=int, default=100_000, help="expense rows in the generated ledger")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--readers", type=int, default=16, help="reader threads, each sending requests back to back")
+    parser.add_argument("--writers", type=int, default=2, help="writer threads")
+    parser.add_argument("--write-rate", type=float, default=50, help="records posted per second by each writer")
+    parser.add_argument("--server-readers", type=int, default=8, help="read-only connections in the server's pool")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run")
+    parser.add_argument("--output", help="write the JSON results to this file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="tracker-load-") as workdir:
+        server = None
+        url = args.url
+        if url is None:
+            db_path = os.path.join(workdir, "load.db")
+            prepare_database(db_path, args.rows, args.seed)
+            port = free_port()
+            server = start_server(db_path, port, args.server_readers)
+            url = f"http://127.0.0.1:{port}"
+        try:
+            token = login(url, args.username, args.password)
+            results = run(url, token, args.readers, args.writers, args.write_rate, args.duration)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    results["meta"] = {"url": args.url or "local", "rows": None if args.url else args.rows,
+                       "readers": args.readers, "writers": args.writers, "write_rate": args.write_rate,
+                       "duration": args.duration, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    return 1 if results["reads"]["errors"] or results["writes"]["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
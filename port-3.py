@@ -4,885 +4,3682 @@ Created on Sep, 2024
 @author: Ayoub Wahmane/securityinshadows
 Copyright (c) <2024> <Ayoub Wahmane>. All rights reserved
 """
+import argparse
+import atexit
+import bisect
+import calendar
+import csv
+import difflib
+import functools
+import getpass
+import glob
+import gzip
+import hashlib
+import json
+import os
+import queue
+import re
+import secrets
+import shlex
 import sqlite3
-from datetime import datetime
-from typing import List
+import sys
+import threading
+import time
+import urllib.parse
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import MAXYEAR, date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+try:
+    import fcntl  # Locks the write journals (msvcrt on Windows)
+except ImportError:
+    fcntl = None
+    import msvcrt
+from typing import Dict, Iterator, List, Tuple
 from typing import Optional
 import bcrypt
 
-# Create connection & cursor
-conn = sqlite3.connect('expense_tracker.db')
-c = conn.cursor()
-
-# Create tables if they don't exist already
-c.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    username TEXT UNIQUE NOT NULL,
-    password_hash TEXT NOT NULL,
-    role TEXT DEFAULT 'user'
-);
-''')
-
-c.execute('''
-CREATE TABLE IF NOT EXISTS expense_categories (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    category_name TEXT UNIQUE NOT NULL
-);
-''')
-
-c.execute('''
-CREATE TABLE IF NOT EXISTS income_categories (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    category_name TEXT UNIQUE NOT NULL
-);
-''')
-
-c.execute('''
-CREATE TABLE IF NOT EXISTS expenses (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    amount INTEGER NOT NULL,
-    category_id INTEGER NOT NULL,
-    date TEXT NOT NULL,
-    FOREIGN KEY (user_id) REFERENCES users(id),
-    FOREIGN KEY (category_id) REFERENCES expense_categories(id)
-);
-''')
-
-c.execute('''
-CREATE TABLE IF NOT EXISTS income (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER NOT NULL,
-    amount INTEGER NOT NULL,
-    category_id INTEGER NOT NULL,
-    date TEXT NOT NULL,
-    FOREIGN KEY (user_id) REFERENCES users(id),
-    FOREIGN KEY (category_id) REFERENCES income_categories(id)
-);
-''')
-
-c.execute('''
-CREATE TABLE IF NOT EXISTS total (
-    user_id INTEGER NOT NULL,
-    totalexp INTEGER DEFAULT 0,
-    totalinc INTEGER DEFAULT 0,
-    totalrev INTEGER DEFAULT 0,
-    FOREIGN KEY (user_id) REFERENCES users(id)
-);
-''')
-
-conn.commit()  # Commit the table creation
-conn.close()   # Close the connection
-
-
-# Initialize program lists
-expenses_list = []
-income_list = []
-category_list = []
-total_list = []
-income_cat_list: List[str] = ["salary", "freelance", "other"]
-
-# Connect to the database
-def connect_db():
-    return sqlite3.connect('expense_tracker.db')
+# pyarrow is optional and slow to import, so only the Parquet export imports it (see import_pyarrow)
+pa = None
+pq = None
+
+DB_PATH = 'expense_tracker.db'
+# Read-only session (--read-only): the shared connection opens the file with mode=ro, so this
+# process never writes or takes a write lock, and under WAL it runs alongside a writer.
+READ_ONLY = False
+READ_ONLY_COMMANDS = ("search", "find", "report", "export")
+NO_MATCH = 3  # Exit status of search and find when nothing matched: not a failure, so a batch carries on
+MMAP_SIZE = 1 << 30  # Read-only connections map up to 1 GiB of the file instead of copying pages
+
+# Shared connection state
+_conn: Optional[sqlite3.Connection] = None
+_tx_depth = 0
+_write_lock = threading.Lock()  # Threads writing through the shared connection take turns
+# A read-only connection borrowed from the pool for the current request, if any
+_read_conn: ContextVar[Optional[sqlite3.Connection]] = ContextVar("read_conn", default=None)
+
+# Connect to the database (one long-lived connection for the whole program)
+def connect_db() -> sqlite3.Connection:
+    global _conn
+    read_conn = _read_conn.get()
+    if read_conn is not None:
+        return read_conn
+    if _conn is None and READ_ONLY:
+        _conn = connect_readonly()
+        atexit.register(close_db)
+    elif _conn is None:
+        # A larger statement cache lets every function reuse its prepared statements.
+        # The server hands this connection between threads, one writer at a time.
+        _conn = sqlite3.connect(DB_PATH, cached_statements=256, check_same_thread=False)
+        _conn.execute('PRAGMA journal_mode = WAL')    # Readers don't block the writer
+        _conn.execute('PRAGMA synchronous = NORMAL')  # No fsync per commit, still safe under WAL
+        _conn.execute('PRAGMA cache_size = -65536')   # 64 MiB page cache for index-heavy reports
+        if METRICS_PATH:
+            _conn.set_trace_callback(trace_sql)
+        atexit.register(close_db)
+    return _conn
+
+# Close the shared connection, committing anything still pending
+def close_db():
+    global _conn
+    if _conn is None:
+        return
+    stop_flusher()  # Queued writes are committed, and the journal cleaned up, while the connection is open
+    try:
+        _conn.commit()
+        if not READ_ONLY:
+            _conn.execute('PRAGMA optimize')  # May run ANALYZE, which writes
+    except sqlite3.Error as e:
+        print(f"An error occurred while closing the database: {e}")
+    finally:
+        _conn.close()
+        _conn = None
+        _category_ids.clear()  # The registry reloads on the next connection
+
+# Open an extra read-only connection; under WAL it reads alongside the writer without blocking
+def connect_readonly() -> sqlite3.Connection:
+    uri = f"file:{urllib.parse.quote(os.path.abspath(DB_PATH))}?mode=ro"
+    conn = sqlite3.connect(uri, uri=True, cached_statements=256, check_same_thread=False)
+    conn.execute('PRAGMA cache_size = -16384')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')  # Pages are read straight from the OS cache
+    if METRICS_PATH:
+        conn.set_trace_callback(trace_sql)
+    return conn
+
+# Group writes into a single commit; nested blocks join the outermost one.
+# A nested block runs in a savepoint, so if it fails only its own writes are undone.
+@contextmanager
+def transaction():
+    global _tx_depth
+    conn = connect_db()
+    _tx_depth += 1
+    savepoint = f"tx{_tx_depth}" if _tx_depth > 1 else None
+    if savepoint:
+        conn.execute(f'SAVEPOINT {savepoint}')
+    elif not conn.in_transaction:
+        conn.execute('BEGIN')  # Explicit, so a savepoint opened first can't commit on release
+    try:
+        yield conn
+    except BaseException:
+        _tx_depth -= 1
+        if savepoint:
+            conn.execute(f'ROLLBACK TO {savepoint}')
+            conn.execute(f'RELEASE {savepoint}')
+        else:
+            conn.rollback()
+        raise
+    _tx_depth -= 1
+    if savepoint:
+        conn.execute(f'RELEASE {savepoint}')
+    else:
+        conn.commit()
+
+# Instrumentation, switched on by TRACKER_METRICS=<file>. Functions marked @timed record a latency
+# histogram, the rows they wrote and returned, and the SQL statements they ran; every statement
+# is also counted by type through the connections' trace callback. On exit the metrics are written
+# to the file: JSON if the name ends in .json, Prometheus text format otherwise. When the variable
+# is unset @timed returns the function unchanged and no trace callback is set, so nothing is added.
+METRICS_PATH = os.environ.get("TRACKER_METRICS") or None
+METRICS_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)  # Histogram bounds in seconds
+
+_instrument_lock = threading.Lock()
+_op_metrics: Dict[str, dict] = {}
+_sql_counts: List[Dict[str, int]] = []  # One dict of statement counts per thread that has run SQL
+_op_local = threading.local()
+_sql_verb = re.compile(r"\s*(--|\w+)")
+
+# Called by SQLite for every statement, executemany rows included, so it only touches this thread's counts
+def thread_sql_counts() -> Dict[str, int]:
+    counts = getattr(_op_local, "sql_counts", None)
+    if counts is None:
+        counts = _op_local.sql_counts = {}
+        with _instrument_lock:
+            _sql_counts.append(counts)
+    return counts
+
+def trace_sql(statement: str):
+    match = _sql_verb.match(statement)
+    verb = "" if match is None else "TRIGGER" if match[1] == "--" else match[1].upper()  # "--" marks a trigger's statements
+    counts = getattr(_op_local, "sql_counts", None) or thread_sql_counts()
+    counts[verb] = counts.get(verb, 0) + 1
+
+def record_operation(name: str, seconds: float, rows_written: int, rows_returned: int, statements: int,
+                     failed: bool):
+    with _instrument_lock:
+        stats = _op_metrics.get(name)
+        if stats is None:
+            stats = _op_metrics[name] = {"count": 0, "errors": 0, "seconds": 0.0, "rows_written": 0,
+                                         "rows_returned": 0, "statements": 0,
+                                         "buckets": [0] * (len(METRICS_BUCKETS) + 1)}
+        stats["count"] += 1
+        stats["errors"] += failed
+        stats["seconds"] += seconds
+        stats["rows_written"] += rows_written
+        stats["rows_returned"] += rows_returned
+        stats["statements"] += statements
+        stats["buckets"][bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+
+# Decorator for the operations worth timing (menu actions and the main database access points).
+# Rows written come from the connection's change counter (trigger writes included), so a
+# concurrent writer on the shared connection can add to them. Rows returned counts list results.
+def timed(fn):
+    if not METRICS_PATH:
+        return fn
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        conn = connect_db()
+        changes = conn.total_changes
+        counts = thread_sql_counts()
+        statements = sum(counts.values())
+        result = None
+        failed = True
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            record_operation(fn.__name__, time.perf_counter() - start, conn.total_changes - changes,
+                             len(result) if isinstance(result, list) else 0,
+                             sum(counts.values()) - statements, failed)
+    return wrapper
+
+def metrics_snapshot() -> dict:
+    with _instrument_lock:
+        operations = {name: {**stats, "buckets": list(stats["buckets"])} for name, stats in _op_metrics.items()}
+        statements: Dict[str, int] = {}
+        for counts in _sql_counts:
+            for verb, count in list(counts.items()):
+                statements[verb] = statements.get(verb, 0) + count
+    for stats in operations.values():
+        stats["mean_ms"] = round(stats["seconds"] / stats["count"] * 1000, 3)
+        stats["buckets"] = dict(zip([str(b) for b in METRICS_BUCKETS] + ["+Inf"], stats["buckets"]))
+    return {"operations": operations, "sql_statements": statements}
+
+def prometheus_metrics(snapshot: dict) -> str:
+    lines = ["# HELP tracker_operation_seconds Time spent in each timed operation.",
+             "# TYPE tracker_operation_seconds histogram"]
+    for name, stats in snapshot["operations"].items():
+        cumulative = 0
+        for bound, count in stats["buckets"].items():
+            cumulative += count
+            lines.append(f'tracker_operation_seconds_bucket{{operation="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'tracker_operation_seconds_sum{{operation="{name}"}} {stats["seconds"]:.6f}')
+        lines.append(f'tracker_operation_seconds_count{{operation="{name}"}} {stats["count"]}')
+    for key, help_text in (("errors", "Timed operations that raised."),
+                           ("rows_written", "Rows written by timed operations, trigger writes included."),
+                           ("rows_returned", "Rows returned by timed operations."),
+                           ("statements", "SQL statements run by timed operations.")):
+        lines.append(f"# HELP tracker_operation_{key}_total {help_text}")
+        lines.append(f"# TYPE tracker_operation_{key}_total counter")
+        for name, stats in snapshot["operations"].items():
+            lines.append(f'tracker_operation_{key}_total{{operation="{name}"}} {stats[key]}')
+    lines.append("# HELP tracker_sql_statements_total SQL statements run, by statement type.")
+    lines.append("# TYPE tracker_sql_statements_total counter")
+    for verb, count in sorted(snapshot["sql_statements"].items()):
+        lines.append(f'tracker_sql_statements_total{{statement="{verb}"}} {count}')
+    return "\n".join(lines) + "\n"
+
+# Write the metrics file, replacing the previous one in a single step
+def write_metrics(path: Optional[str] = None):
+    path = path or METRICS_PATH
+    snapshot = metrics_snapshot()
+    output = (json.dumps(snapshot, indent=2) + "\n" if path.endswith(".json")
+              else prometheus_metrics(snapshot))
+    try:
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(output)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        print(f"Could not write metrics to '{path}': {e}", file=sys.stderr)
+
+if METRICS_PATH:
+    atexit.register(write_metrics)
+
+# Recount of every user's totals, used to seed and verify the total table
+FRESH_TOTALS_SQL = '''
+    SELECT user_id, SUM(exp) AS totalexp, SUM(inc) AS totalinc, SUM(inc) - SUM(exp) AS totalrev
+    FROM (
+        SELECT user_id, amount AS exp, 0 AS inc FROM expenses
+        UNION ALL
+        SELECT user_id, 0 AS exp, amount AS inc FROM income
+    )
+    GROUP BY user_id
+'''
+
+# Schema migrations, applied in order. PRAGMA user_version counts how many have run, so opening a
+# current database reads one pragma and runs no DDL. To change the schema, append a function to
+# MIGRATIONS; never edit one that has already shipped. Databases from before versioning start at
+# version 0 and run them all, which is why the early ones skip whatever already exists.
+
+def migrate_base_tables(c: sqlite3.Cursor):
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        role TEXT DEFAULT 'user'
+    );
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS expense_categories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        category_name TEXT UNIQUE NOT NULL
+    );
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS income_categories (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        category_name TEXT UNIQUE NOT NULL
+    );
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS expenses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        category_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        external_ref TEXT,
+        content_hash BLOB,
+        note TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        FOREIGN KEY (category_id) REFERENCES expense_categories(id)
+    );
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS income (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        category_id INTEGER NOT NULL,
+        date TEXT NOT NULL,
+        external_ref TEXT,
+        content_hash BLOB,
+        note TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(id),
+        FOREIGN KEY (category_id) REFERENCES income_categories(id)
+    );
+    ''')
+
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS total (
+        user_id INTEGER NOT NULL,
+        totalexp INTEGER DEFAULT 0,
+        totalinc INTEGER DEFAULT 0,
+        totalrev INTEGER DEFAULT 0,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    );
+    ''')
+
+    # Sequence number of the last queued write committed (see flush_writes)
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS write_journal_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        last_seq INTEGER NOT NULL DEFAULT 0
+    );
+    ''')
+
+    # Remembers how far each incremental export has got
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS export_state (
+        target TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL DEFAULT 0
+    );
+    ''')
+
+def migrate_search_indexes(c: sqlite3.Cursor):
+    # Indexes backing the search queries. Every one leads with user_id, so a user's queries
+    # only ever touch that user's slice of the index.
+    for table in ("expenses", "income"):
+        for old_index in ("user_date", "category", "amount"):
+            c.execute(f'DROP INDEX IF EXISTS idx_{table}_{old_index}')
+        # (user_id, date) leads so per-user date ranges seek; category_id and amount make it covering for reports
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_user_date_cover ON {table} (user_id, date, category_id, amount)')
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_user_category ON {table} (user_id, category_id)')
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_user_amount ON {table} (user_id, amount)')
+        # (user_id, id) order for keyset paging through one user's records
+        c.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_user ON {table} (user_id)')
+
+def migrate_total_triggers(c: sqlite3.Cursor):
+    # Keep the total table up to date from triggers, so reading a user's totals is a single row lookup
+    totals_ready = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'trg_expenses_total_insert'").fetchone()
+    if not totals_ready:
+        c.execute('DELETE FROM total')  # Never written before the triggers existed
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_total_user ON total (user_id)')
+    for table, column, sign in (("expenses", "totalexp", "-"), ("income", "totalinc", "")):
+        c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_total_insert AFTER INSERT ON {table}
+        BEGIN
+            INSERT INTO total (user_id, {column}, totalrev) VALUES (NEW.user_id, NEW.amount, {sign}NEW.amount)
+            ON CONFLICT (user_id) DO UPDATE SET {column} = {column} + excluded.{column},
+                                                totalrev = totalrev + excluded.totalrev;
+        END;
+        ''')
+        c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_total_update AFTER UPDATE OF amount, user_id ON {table}
+        BEGIN
+            UPDATE total SET {column} = {column} - OLD.amount, totalrev = totalrev - ({sign}OLD.amount)
+            WHERE user_id = OLD.user_id;
+            INSERT INTO total (user_id, {column}, totalrev) VALUES (NEW.user_id, NEW.amount, {sign}NEW.amount)
+            ON CONFLICT (user_id) DO UPDATE SET {column} = {column} + excluded.{column},
+                                                totalrev = totalrev + excluded.totalrev;
+        END;
+        ''')
+        c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_total_delete AFTER DELETE ON {table}
+        BEGIN
+            UPDATE total SET {column} = {column} - OLD.amount, totalrev = totalrev - ({sign}OLD.amount)
+            WHERE user_id = OLD.user_id;
+        END;
+        ''')
+    if not totals_ready:
+        # Seed totals for records written before the triggers existed
+        c.execute(f'INSERT INTO total (user_id, totalexp, totalinc, totalrev) {FRESH_TOTALS_SQL}')
+
+def migrate_default_income_categories(c: sqlite3.Cursor):
+    c.executemany('INSERT OR IGNORE INTO income_categories (category_name) VALUES (?)',
+                  [(category,) for category in DEFAULT_INCOME_CATEGORIES])
+
+def migrate_record_hashes(c: sqlite3.Cursor):
+    # Duplicate detection: each record carries a hash of its contents, unique per table.
+    # Databases from before this get the columns added; their rows stay NULL until dedupe_records().
+    for table in ("expenses", "income"):
+        columns = {row[1] for row in c.execute(f'PRAGMA table_info({table})')}
+        if "external_ref" not in columns:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN external_ref TEXT')
+        if "content_hash" not in columns:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN content_hash BLOB')
+        c.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_content_hash ON {table} (content_hash)')
+
+def migrate_note_search(c: sqlite3.Cursor):
+    # Full-text index over notes. External content: the FTS table stores only the index and reads
+    # note text from the record table. Only records with a note are indexed; triggers keep it in step.
+    for table in ("expenses", "income"):
+        columns = {row[1] for row in c.execute(f'PRAGMA table_info({table})')}
+        if "note" not in columns:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN note TEXT')
+        fts_ready = c.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (f'{table}_fts',)).fetchone()
+        c.execute(f'''
+        CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5(
+            note, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        );
+        ''')
+        # The indexed words, read by fuzzy search
+        c.execute(f'CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts_vocab USING fts5vocab({table}_fts, row)')
+        c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_insert AFTER INSERT ON {table} WHEN NEW.note IS NOT NULL
+        BEGIN
+            INSERT INTO {table}_fts (rowid, note) VALUES (NEW.id, NEW.note);
+        END;
+        ''')
+        c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_update AFTER UPDATE OF note ON {table}
+        BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, note) SELECT 'delete', OLD.id, OLD.note WHERE OLD.note IS NOT NULL;
+            INSERT INTO {table}_fts (rowid, note) SELECT NEW.id, NEW.note WHERE NEW.note IS NOT NULL;
+        END;
+        ''')
+        c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_fts_delete AFTER DELETE ON {table} WHEN OLD.note IS NOT NULL
+        BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, note) VALUES ('delete', OLD.id, OLD.note);
+        END;
+        ''')
+        if not fts_ready:
+            c.execute(f'INSERT INTO {table}_fts (rowid, note) SELECT id, note FROM {table} WHERE note IS NOT NULL')
+
+# Store record dates as day ordinals (see JULIAN_DAY_OFFSET) instead of 'YYYY-MM-DD' text, so date
+# filters compare integers. SQLite can't change a column's type, so each record table is rebuilt
+# and its indexes and triggers recreated; ids, content hashes (computed from the ISO text, which
+# converts back exactly) and the AUTOINCREMENT counter carry over.
+def migrate_integer_dates(c: sqlite3.Cursor):
+    for table, cat_table in (("expenses", "expense_categories"), ("income", "income_categories")):
+        # Category deletion used to overwrite the date with 'uncategorized'. Those dates are lost;
+        # give each such record the date of the same user's previous record (or next, or today).
+        damaged = c.execute(f'SELECT id, user_id FROM {table} WHERE julianday(date) IS NULL').fetchall()
+        for record_id, user_id in damaged:
+            row = (c.execute(f'''SELECT date FROM {table} WHERE user_id = ? AND id < ? AND julianday(date) IS NOT NULL
+                                ORDER BY id DESC LIMIT 1''', (user_id, record_id)).fetchone()
+                   or c.execute(f'''SELECT date FROM {table} WHERE user_id = ? AND id > ? AND julianday(date) IS NOT NULL
+                                   ORDER BY id LIMIT 1''', (user_id, record_id)).fetchone())
+            c.execute(f'UPDATE {table} SET date = ?, content_hash = NULL WHERE id = ?',
+                      (row[0] if row else date.today().isoformat(), record_id))
+        if damaged:
+            print(f"{len(damaged)} {table} records had no valid date and were given the date of a neighbouring record.",
+                  file=sys.stderr)
+
+        sequence = c.execute('SELECT seq FROM sqlite_sequence WHERE name = ?', (table,)).fetchone()
+        c.execute(f'''
+        CREATE TABLE {table}_rebuild (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount INTEGER NOT NULL,
+            category_id INTEGER NOT NULL,
+            date INTEGER NOT NULL CHECK (typeof(date) = 'integer' AND date BETWEEN 1 AND {MAX_DAY}),
+            external_ref TEXT,
+            content_hash BLOB,
+            note TEXT,
+            FOREIGN KEY (user_id) REFERENCES users(id),
+            FOREIGN KEY (category_id) REFERENCES {cat_table}(id)
+        );
+        ''')
+        c.execute(f'''
+        INSERT INTO {table}_rebuild (id, user_id, amount, category_id, date, external_ref, content_hash, note)
+        SELECT id, user_id, amount, category_id, CAST(julianday(date) - {JULIAN_DAY_OFFSET} AS INTEGER),
+               external_ref, content_hash, note
+        FROM {table}
+        ORDER BY id
+        ''')
+        c.execute(f'DROP TABLE {table}')  # Its indexes and triggers go with it
+        c.execute(f'ALTER TABLE {table}_rebuild RENAME TO {table}')
+        if sequence:
+            c.execute('UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = ?', (sequence[0], table))
+
+    # The totals triggers are missing now, so this also recounts the total table
+    migrate_search_indexes(c)
+    migrate_total_triggers(c)
+    migrate_record_hashes(c)
+    migrate_note_search(c)
+
+def migrate_recurring_rules(c: sqlite3.Cursor):
+    # Recurring records. Dates are day numbers like the record tables; materialized_through is the
+    # last day whose occurrences have been written (the day before start_date until the first run).
+    # category_id points into the kind's category table, so there is no foreign key.
+    c.execute(f'''
+    CREATE TABLE IF NOT EXISTS recurring_rules (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        kind TEXT NOT NULL CHECK (kind IN ('expense', 'income')),
+        amount INTEGER NOT NULL CHECK (amount > 0),
+        category_id INTEGER NOT NULL,
+        cadence TEXT NOT NULL,
+        start_date INTEGER NOT NULL CHECK (start_date BETWEEN 1 AND {MAX_DAY}),
+        end_date INTEGER CHECK (end_date >= start_date),
+        materialized_through INTEGER NOT NULL,
+        note TEXT,
+        FOREIGN KEY (user_id) REFERENCES users(id)
+    );
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_recurring_rules_due ON recurring_rules (materialized_through)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_recurring_rules_user ON recurring_rules (user_id)')
+
+def migrate_write_journals(c: sqlite3.Cursor):
+    # One write journal per writing process, each with its own committed position. The single
+    # journal from before this keeps its position under the name '' (see journal_name).
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS write_journals (
+        journal TEXT PRIMARY KEY,
+        last_seq INTEGER NOT NULL DEFAULT 0
+    );
+    ''')
+    c.execute("INSERT OR IGNORE INTO write_journals (journal, last_seq) "
+              "SELECT '', last_seq FROM write_journal_state WHERE id = 1")
+    c.execute('DROP TABLE IF EXISTS write_journal_state')
+
+def migrate_admin_role(c: sqlite3.Cursor):
+    # users.role 'admin' may act on every user's data (see require_admin). The first account is the
+    # admin: on an existing database the oldest one, on a new one whoever registers first.
+    c.execute("UPDATE users SET role = 'admin' WHERE id = (SELECT MIN(id) FROM users) "
+              "AND NOT EXISTS (SELECT 1 FROM users WHERE role = 'admin')")
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_users_first_admin AFTER INSERT ON users
+    WHEN NOT EXISTS (SELECT 1 FROM users WHERE role = 'admin')
+    BEGIN
+        UPDATE users SET role = 'admin' WHERE id = NEW.id;
+    END;
+    ''')
+
+def migrate_note_search_by_user(c: sqlite3.Cursor):
+    # Index the owner alongside each note, so a search matches one user's postings (user_id : 5 AND
+    # note : ...) instead of every user's and filtering afterwards. The vocabulary becomes per column,
+    # so fuzzy search only reads note words.
+    for table in ("expenses", "income"):
+        for trigger in ("insert", "update", "delete"):
+            c.execute(f'DROP TRIGGER IF EXISTS trg_{table}_fts_{trigger}')
+        c.execute(f'DROP TABLE IF EXISTS {table}_fts_vocab')
+        c.execute(f'DROP TABLE IF EXISTS {table}_fts')
+        c.execute(f'''
+        CREATE VIRTUAL TABLE {table}_fts USING fts5(
+            note, user_id, content='{table}', content_rowid='id', tokenize='unicode61 remove_diacritics 2',
+            prefix='2 3'
+        );
+        ''')
+        c.execute(f'CREATE VIRTUAL TABLE {table}_fts_vocab USING fts5vocab({table}_fts, col)')
+        c.execute(f'''
+        CREATE TRIGGER trg_{table}_fts_insert AFTER INSERT ON {table} WHEN NEW.note IS NOT NULL
+        BEGIN
+            INSERT INTO {table}_fts (rowid, note, user_id) VALUES (NEW.id, NEW.note, NEW.user_id);
+        END;
+        ''')
+        c.execute(f'''
+        CREATE TRIGGER trg_{table}_fts_update AFTER UPDATE OF note, user_id ON {table}
+        BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, note, user_id)
+            SELECT 'delete', OLD.id, OLD.note, OLD.user_id WHERE OLD.note IS NOT NULL;
+            INSERT INTO {table}_fts (rowid, note, user_id) SELECT NEW.id, NEW.note, NEW.user_id WHERE NEW.note IS NOT NULL;
+        END;
+        ''')
+        c.execute(f'''
+        CREATE TRIGGER trg_{table}_fts_delete AFTER DELETE ON {table} WHEN OLD.note IS NOT NULL
+        BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, note, user_id) VALUES ('delete', OLD.id, OLD.note, OLD.user_id);
+        END;
+        ''')
+        c.execute(f'INSERT INTO {table}_fts (rowid, note, user_id) SELECT id, note, user_id FROM {table} WHERE note IS NOT NULL')
+
+MIGRATIONS = [
+    migrate_base_tables,
+    migrate_search_indexes,
+    migrate_total_triggers,
+    migrate_default_income_categories,
+    migrate_record_hashes,
+    migrate_note_search,
+    migrate_integer_dates,
+    migrate_recurring_rules,
+    migrate_write_journals,
+    migrate_admin_role,
+    migrate_note_search_by_user,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Run the migrations the database hasn't had, each in its own transaction with the version bump.
+# BEGIN IMMEDIATE takes the write lock before reading the version, so when two processes start on
+# an old database together the second waits and then finds the work done.
+def migrate(conn: sqlite3.Connection):
+    while True:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                conn.commit()
+                return
+            MIGRATIONS[version](conn.cursor())
+            conn.execute(f'PRAGMA user_version = {version + 1}')
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+# Bring the schema up to date and replay any writes left in the journal
+def init_db():
+    conn = connect_db()
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise sqlite3.DatabaseError(f"{DB_PATH} has schema version {version}, newer than this program "
+                                    f"({SCHEMA_VERSION}). Please upgrade.")
+    if READ_ONLY:
+        if version < SCHEMA_VERSION:
+            raise sqlite3.DatabaseError(f"{DB_PATH} has schema version {version} and needs upgrading, "
+                                        "which a read-only session can't do. Open it once without --read-only.")
+        return  # Queued writes left by a crash are replayed by the next writing session
+    if version < SCHEMA_VERSION:
+        migrate(conn)
+    recover_write_journal()
+
+
+# Record tables and their category tables (fixed names, never built from user input)
+RECORD_TABLES = {
+    "expense": ("expenses", "expense_categories"),
+    "income": ("income", "income_categories"),
+}
+IMPORT_CHUNK_SIZE = 10000  # Rows per transaction during bulk imports
+DEDUPE_CHUNK_SIZE = 100000  # Rows hashed per transaction by the dedupe pass (fewer commits, fewer index page rewrites)
+PAGE_SIZE = 20             # Records shown per page when browsing
+STREAM_PAGE_SIZE = 1000    # Records fetched per query when streaming reports
+EXPORT_BATCH_SIZE = 5000   # Rows per fetchmany() call during CSV export
+EXPORT_BUFFER_SIZE = 1 << 20
+PARQUET_ROW_GROUP_SIZE = 100000  # Rows per Parquet row group
+# Sort options for browsing and searching: (sort column, direction). Each is served in index
+# order, ties broken by id, so a page costs the same however far into the results it is.
+SORT_ORDERS = {
+    "id": (None, "ASC"),              # Order of entry
+    "date": ("date", "ASC"),
+    "date_desc": ("date", "DESC"),
+    "amount": ("amount", "ASC"),
+    "amount_desc": ("amount", "DESC"),
+    "category": ("category", "ASC"),  # Category name, A to Z
+}
+# strftime() patterns used to bucket dates for summary reports
+PERIOD_FORMATS = {"week": "%Y-W%W", "month": "%Y-%m", "year": "%Y"}
+
+# Record dates are stored as day ordinals (date.toordinal(): 0001-01-01 is day 1). SQLite's date
+# functions take Julian day numbers, which at midnight are the ordinal plus this offset.
+JULIAN_DAY_OFFSET = 1721424.5
+MAX_DAY = date.max.toordinal()
+UNIX_EPOCH_DAY = date(1970, 1, 1).toordinal()  # Parquet's date32 counts days from here
+
+DEFAULT_INCOME_CATEGORIES = ("salary", "freelance", "other")
+UNCATEGORIZED = "uncategorized"  # Where records go when their category is deleted
+
+# Category registry: name -> id and id -> name for both category tables. Loaded once, then kept
+# in step with our own writes. Other processes' commits change PRAGMA data_version, which
+# triggers a reload; a name we don't know also gets one reload before it's treated as missing.
+CATEGORY_RECHECK_SECONDS = 1.0  # How often data_version is polled, so lookups stay dict-only
+_category_ids: Dict[str, Dict[str, int]] = {}
+_category_names: Dict[str, Dict[int, str]] = {}
+_category_versions: Dict[int, Tuple[int, float]] = {}  # id(connection) -> (data_version, checked at)
+_category_lock = threading.Lock()
+
+# The user every query is scoped to. A ContextVar, so each server thread or task has its own.
+current_user: ContextVar[Optional[int]] = ContextVar("current_user", default=None)
+
+def set_current_user(user_id: int):
+    current_user.set(user_id)
+
+# Run a block of code as a given user
+@contextmanager
+def user_scope(user_id: int):
+    token = current_user.set(user_id)
+    try:
+        yield
+    finally:
+        current_user.reset(token)
+
+# Resolve the user a query runs for; an explicit user_id wins over the current scope
+def scoped_user(user_id: Optional[int] = None) -> int:
+    if user_id is not None:
+        return user_id
+    user_id = current_user.get()
+    if user_id is None:
+        raise PermissionError("No user is logged in.")
+    return user_id
+
+# True once at least one account has been registered
+def has_users() -> bool:
+    return connect_db().execute('SELECT EXISTS (SELECT 1 FROM users)').fetchone()[0] == 1
+
+# True if the user may act on every user's data. A database without accounts has one user, who is.
+def is_admin(user_id: Optional[int] = None) -> bool:
+    row = connect_db().execute('SELECT role FROM users WHERE id = ?', (scoped_user(user_id),)).fetchone()
+    return row[0] == 'admin' if row else not has_users()
+
+# Raise PermissionError unless the current user is an admin
+def require_admin(action: str):
+    if not is_admin():
+        raise PermissionError(f"Only an admin can {action}.")
+
+# Authentication settings
+BCRYPT_ROUNDS = 12                # Cost factor for new password hashes
+AUTH_WORKERS = 4                  # Threads available for bcrypt work
+SESSION_TTL = 15 * 60             # Seconds a session token stays valid
+MAX_FAILED_LOGINS = 5             # Failed attempts allowed per username...
+FAILED_LOGIN_WINDOW = 5 * 60      # ...within this many seconds
+
+# Authentication state, shared by every thread that logs users in
+_auth_pool: Optional[ThreadPoolExecutor] = None
+_auth_lock = threading.Lock()
+_sessions: Dict[str, Tuple[int, float]] = {}        # token -> (user_id, expires_at)
+_sessions_swept = 0.0                               # When expired sessions were last dropped
+_failed_logins: Dict[str, List[float]] = {}         # username -> recent failure times, oldest first
+_failed_logins_swept = 0.0                          # When expired usernames were last dropped
+_dummy_hash: Optional[bytes] = None                 # Checked for unknown users so timing doesn't leak them
+
+# bcrypt releases the GIL, so hashing on worker threads keeps the caller responsive
+def auth_pool() -> ThreadPoolExecutor:
+    global _auth_pool
+    if _auth_pool is None:
+        _auth_pool = ThreadPoolExecutor(max_workers=AUTH_WORKERS, thread_name_prefix="bcrypt")
+        atexit.register(_auth_pool.shutdown)
+    return _auth_pool
+
+def hash_password(password: str) -> bytes:
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS))
+
+# Fetch a user's id and password hash; unknown users get a dummy hash to check against
+def password_record(username: str) -> Tuple[Optional[int], bytes]:
+    global _dummy_hash
+    c = connect_db().cursor()
+    c.execute('SELECT id, password_hash FROM users WHERE username = ?', (username,))
+    user = c.fetchone()
+    if user is None:
+        if _dummy_hash is None:
+            _dummy_hash = hash_password("not a real password")
+        return None, _dummy_hash
+    stored = user[1]
+    return user[0], stored if isinstance(stored, bytes) else stored.encode('utf-8')
+
+# Raised while a username is locked out after too many failed logins. It is a PermissionError, so
+# callers that only care about "not allowed" need not tell it apart; the API answers it with 429.
+class LoginLockedOut(PermissionError):
+    pass
+
+# Raise LoginLockedOut while a username is locked out after too many failed logins
+def check_login_allowed(username: str):
+    now = time.monotonic()
+    with _auth_lock:
+        recent = [t for t in _failed_logins.get(username, []) if now - t < FAILED_LOGIN_WINDOW]
+        if recent:
+            _failed_logins[username] = recent
+        else:
+            _failed_logins.pop(username, None)
+    if len(recent) >= MAX_FAILED_LOGINS:
+        raise LoginLockedOut("Too many failed login attempts. Please try again later.")
+
+# Failures for usernames nobody retries would otherwise stay forever, so once per window
+# every username whose latest failure has expired is dropped.
+def record_login_result(username: str, success: bool):
+    global _failed_logins_swept
+    now = time.monotonic()
+    with _auth_lock:
+        if success:
+            _failed_logins.pop(username, None)
+            return
+        _failed_logins.setdefault(username, []).append(now)
+        if now - _failed_logins_swept >= FAILED_LOGIN_WINDOW:
+            for name in [name for name, times in _failed_logins.items() if now - times[-1] >= FAILED_LOGIN_WINDOW]:
+                del _failed_logins[name]
+            _failed_logins_swept = now
+
+# Tokens that are never presented again would otherwise stay forever, so once per SESSION_TTL
+# every expired session is dropped.
+def create_session(user_id: int) -> str:
+    global _sessions_swept
+    token = secrets.token_urlsafe(32)
+    now = time.monotonic()
+    with _auth_lock:
+        _sessions[token] = (user_id, now + SESSION_TTL)
+        if now - _sessions_swept >= SESSION_TTL:
+            for expired in [t for t, (_, expires_at) in _sessions.items() if expires_at <= now]:
+                del _sessions[expired]
+            _sessions_swept = now
+    return token
+
+# Return the user id for a live session token (no bcrypt involved), None if unknown or expired
+def session_user(token: str) -> Optional[int]:
+    with _auth_lock:
+        session = _sessions.get(token)
+        if session is None:
+            return None
+        if session[1] <= time.monotonic():
+            del _sessions[token]
+            return None
+        return session[0]
+
+def end_session(token: str):
+    with _auth_lock:
+        _sessions.pop(token, None)
+
+# Check credentials on the auth pool without blocking the event loop; returns a session token.
+# The database lookup stays on the calling thread, which owns the connection. For asyncio callers
+# (benchmark.py's concurrent logins); the menu, CLI and API use verify_credentials().
+async def authenticate_async(username: str, password: str) -> Optional[str]:
+    check_login_allowed(username)
+    user_id, stored = password_record(username)
+    import asyncio  # Imported here: only this entry point needs it, and it is slow to load
+    loop = asyncio.get_running_loop()
+    valid = await loop.run_in_executor(auth_pool(), bcrypt.checkpw, password.encode('utf-8'), stored)
+    success = valid and user_id is not None
+    record_login_result(username, success)
+    return create_session(user_id) if success else None
+
+# Create an account; returns the new user id, or None if the username is taken
+def create_user(username: str, password: str) -> Optional[int]:
+    hashed_password = auth_pool().submit(hash_password, password).result()
+    try:
+        with transaction() as conn:
+            return conn.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)',
+                                (username, hashed_password)).lastrowid
+    except sqlite3.IntegrityError:
+        return None
 
 # Register a new user
 def register_user(username: str, password: str):
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
-    conn = connect_db()
-    c = conn.cursor()
-    try:
-        c.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', (username, hashed_password))
-        conn.commit()
-        print("User registered successfully.")
-    except sqlite3.IntegrityError:
-        print("Username already exists.")
-    except Exception as e:
-        print(f"An error occurred during registration: {e}")
-    finally:
-        conn.close()
+    try:
+        if create_user(username, password) is not None:
+            print("User registered successfully.")
+        else:
+            print("Username already exists.")
+    except Exception as e:
+        print(f"An error occurred during registration: {e}")
+
+# Check a username and password; returns the user id, None if they don't match.
+# Raises LoginLockedOut while the username is locked out.
+@timed
+def verify_credentials(username: str, password: str) -> Optional[int]:
+    check_login_allowed(username)
+    user_id, stored = password_record(username)
+    valid = auth_pool().submit(bcrypt.checkpw, password.encode('utf-8'), stored).result()
+    success = valid and user_id is not None
+    record_login_result(username, success)
+    return user_id if success else None
 
 # Authenticate a user
 def authenticate_user(username: str, password: str) -> Optional[int]:
-    conn = connect_db()
-    c = conn.cursor()
-    c.execute('SELECT id, password_hash FROM users WHERE username = ?', (username,))
-    user = c.fetchone()
-    
-    if user and bcrypt.checkpw(password.encode('utf-8'), user[1]):
-        print("User authenticated successfully.")
-        return user[0]  # Return user ID
-    else:
-        print("Authentication failed.")
-        return None
-conn.close()
-# Load information
-
-def load_incat():
-    conn = sqlite3.connect('expense_tracker.db')
-    c = conn.cursor()
-    
-    # List of categories to be inserted
-    income_cat_list = ["salary", "freelance", "other"]
-    
-    for category in income_cat_list:
-        try:
-            c.execute('INSERT OR IGNORE INTO income_categories (category_name) VALUES (?)', (category,))
-        except sqlite3.Error as e:
-            print(f"An error occurred while inserting category '{category}': {e}")
-    
-    conn.commit()  # Commit the transaction
-    conn.close()   # Close the connection
-
-def load_expenses():
-    try:
-        conn = sqlite3.connect('expense_tracker.db')
-        c = conn.cursor()
-        expenses_list.clear()
-        
-        # Fetch details
-        c.execute('''
-            SELECT expenses.id, expenses.amount, expense_categories.category_name, expenses.date 
-            FROM expenses 
-            JOIN expense_categories ON expenses.category_id = expense_categories.id
-        ''')
-        
-        expenses = c.fetchall()
-        
-        for expense in expenses:
-            if expense[1] is not None:
-                expenses_list.append({
-                    "ID": expense[0],     # Use the ID from the expenses table
-                    "Amount": expense[1],
-                    "Category": expense[2],
-                    "Date": expense[3],
-                })
-    except sqlite3.Error as e:
-        print(f"An error occurred while loading expenses: {e}")
-    finally:
-        conn.close()  # Ensure the connection is closed regardless of errors
-
-def load_income():
-    try:
-        conn = sqlite3.connect('expense_tracker.db')
-        c = conn.cursor()
-        income_list.clear()
-        
-        # Fetch details 2.0.
-        c.execute('''
-            SELECT income.id, income.amount, income_categories.category_name, income.date 
-            FROM income 
-            JOIN income_categories ON income.category_id = income_categories.id
-        ''')
-        
-        income = c.fetchall()
-        
-        for inc in income:
-            if inc[1] is not None:
-                income_list.append({
-                    "ID": inc[0],   # Use the ID from the income table (again)
-                    "Amount": inc[1],
-                    "Category": inc[2],
-                    "Date": inc[3],
-                })
-    except sqlite3.Error as e:
-        print(f"An error occurred while loading income records: {e}")
-    finally:
-        conn.close() 
+    try:
+        user_id = verify_credentials(username, password)
+    except PermissionError as e:
+        print(e)
+        return None
+
+    if user_id is not None:
+        print("User authenticated successfully.")
+        return user_id  # Return user ID
+    else:
+        print("Authentication failed.")
+        return None
+
+# (Re)load the category registry from the database
+@timed
 def load_categories():
-    conn = sqlite3.connect('expense_tracker.db')
-    c = conn.cursor()
-    category_list.clear()
-
-    # Get unique categories from expenses
-    c.execute('SELECT DISTINCT category_name FROM expense_categories')
-    categories = c.fetchall()
-    for category in categories:
-        category_list.append(category[0])  # Append each category to the category_list
-
-    conn.close()
+    conn = connect_db()
+    ids = {}
+    for kind, (_, cat_table) in RECORD_TABLES.items():
+        ids[kind] = dict(conn.execute(f'SELECT category_name, id FROM {cat_table} ORDER BY id'))
+    with _category_lock:
+        _category_ids.clear()
+        _category_ids.update(ids)
+        _category_names.clear()
+        _category_names.update({kind: {id_: name for name, id_ in names.items()} for kind, names in ids.items()})
+        _category_versions[id(conn)] = (conn.execute('PRAGMA data_version').fetchone()[0], time.monotonic())
+
+# The registry's name -> id map for one kind, reloaded first if another process has written since
+def category_registry(kind: str) -> Dict[str, int]:
+    conn = connect_db()
+    checked = _category_versions.get(id(conn))
+    if not _category_ids or checked is None:
+        load_categories()
+    elif time.monotonic() - checked[1] >= CATEGORY_RECHECK_SECONDS:
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if version != checked[0]:
+            load_categories()
+        else:
+            _category_versions[id(conn)] = (version, time.monotonic())
+    return _category_ids[kind]
+
+# Category names in creation order, for the selection menus
+def category_names(kind: str) -> List[str]:
+    return list(category_registry(kind))
+
+# Look up a category id by name, None if the category doesn't exist
+def category_id_for(kind: str, name: str) -> Optional[int]:
+    category_id = category_registry(kind).get(name)
+    if category_id is None:
+        load_categories()  # Possibly created by a connection whose commit we haven't seen yet
+        category_id = _category_ids[kind].get(name)
+    return category_id
+
+def category_name_for(kind: str, category_id: int) -> Optional[str]:
+    category_registry(kind)
+    return _category_names[kind].get(category_id)
+
+# Keep the registry in step with our own category writes
+def remember_category(kind: str, name: str, category_id: int):
+    with _category_lock:
+        if _category_ids:
+            _category_ids[kind][name] = category_id
+            _category_names[kind][category_id] = name
+
+def forget_category(kind: str, name: str):
+    with _category_lock:
+        if _category_ids:
+            category_id = _category_ids[kind].pop(name, None)
+            _category_names[kind].pop(category_id, None)
+
+# Normalize a YYYY-MM-DD or YYYY/MM/DD string, raising ValueError if it isn't a valid date
+def parse_date(date_str: str) -> str:
+    normalized_date_str = date_str.strip().replace('/', '-') # Normalize input
+    try:
+        return date.fromisoformat(normalized_date_str).isoformat() # Fast path for well-formed dates
+    except ValueError:
+        pass
+    # Parse the normalized date string using hyphens
+    task_date = datetime.strptime(normalized_date_str, "%Y-%m-%d")
+    return task_date.strftime("%Y-%m-%d") # Return as string
+
+# Stored day number <-> ISO date. Conversions happen where dates enter and leave the program;
+# queries compare the integers.
+def date_ordinal(date_str: str) -> int:
+    return date.fromisoformat(parse_date(date_str)).toordinal()
+
+def ordinal_date(day: int) -> str:
+    return date.fromordinal(day).isoformat()
+
+# SQL for the ISO text of a stored date column, for queries whose rows go straight out
+def iso_date_sql(column: str) -> str:
+    return f"date({column} + {JULIAN_DAY_OFFSET})"
+
+# First and last day of a year (2024), quarter (2024-Q2) or month (2024-06), as ISO dates
+def period_bounds(period: str) -> Tuple[str, str]:
+    match = re.fullmatch(r"(\d{4})(?:-[Qq]([1-4])|-(\d{1,2}))?", period.strip())
+    if match is None or (match[3] and not 1 <= int(match[3]) <= 12):
+        raise ValueError(f"Unknown period '{period}'. Use YYYY, YYYY-Q1..Q4 or YYYY-MM.")
+    year = int(match[1])
+    if match[2]:
+        first_month, months = int(match[2]) * 3 - 2, 3
+    elif match[3]:
+        first_month, months = int(match[3]), 1
+    else:
+        first_month, months = 1, 12
+    last_month = first_month + months - 1
+    return (date(year, first_month, 1).isoformat(),
+            date(year, last_month, calendar.monthrange(year, last_month)[1]).isoformat())
 
 # Ensuring date input is correct
 def get_valid_date():
-    while True:
-        date_str = input("Input the date (YYYY-MM-DD or YYYY/MM/DD): ")
-        normalized_date_str = date_str.replace('/', '-') # Normalize input
-        try:
-    # Parse the normalized date string using hyphens
-            task_date = datetime.strptime(normalized_date_str, "%Y-%m-%d")
-            return task_date.strftime("%Y-%m-%d") # Return as string
-        except ValueError:
-            print("Invalid date format. Please enter the date in YYYY-MM-DD or YYYY/MM/DD format.")
+    while True:
+        date_str = input("Input the date (YYYY-MM-DD or YYYY/MM/DD): ")
+        try:
+            return parse_date(date_str)
+        except ValueError:
+            print("Invalid date format. Please enter the date in YYYY-MM-DD or YYYY/MM/DD format.")
 
 #Main menu prompt
 def welcome():
-    print("Welcome to SiSh Tracker.\n1 - Create Records \n2 - Category Manager \n3 - Search Records\n4 - Edit Records\np - Print Tracker Report\nd - Delete Records \ne - Exit Program ")
+    if READ_ONLY:
+        print("Welcome to SiSh Tracker (read-only).\n3 - Search Records\np - Print Tracker Report\ne - Exit Program")
+        return
+    print("Welcome to SiSh Tracker.\n1 - Create Records \n2 - Category Manager \n3 - Search Records\n4 - Edit Records\n5 - Import Records\np - Print Tracker Report\nr - Recurring Records\nd - Delete Records \ne - Exit Program ")
 
 # United functions
 def create_records(): 
 
-    while True:
-        print("1 - Input Expenses \n2 - Input Incomes")
-        choice = input("Enter your choice:")
-        if choice == "1":
-            add_expense()
-        elif choice == "2":
-            add_income()
-        else:
-            print("Invalid input, try again.")
-            continue
-        break
+    while True:
+        print("1 - Input Expenses \n2 - Input Incomes")
+        choice = input("Enter your choice:")
+        if choice == "1":
+            add_expense()
+        elif choice == "2":
+            add_income()
+        else:
+            print("Invalid input, try again.")
+            continue
+        break
 # United function 2.0
+# Recurring records: list, add or delete rules. Occurrences due are written at login.
+def recurring_menu():
+    print("1 - List Recurring Records\n2 - Add Recurring Record\n3 - Delete Recurring Record")
+    choice = input("Enter your choice:").strip()
+    if choice == "1":
+        rules = list_rules()
+        if not rules:
+            print("No recurring records yet.")
+        for rule_id, kind, amount, category, cadence, start, end, through, note in rules:
+            print(f"Rule #{rule_id}: {kind} of {amount} ({category}), {cadence} from {start}"
+                  + (f" to {end}" if end else "") + (f", written through {through}" if through else "")
+                  + (f" - {note}" if note else ""))
+    elif choice == "2":
+        kind = "income" if input("Expense or income? (e/i): ").strip().lower() == "i" else "expense"
+        try:
+            amount = int(input("Amount: "))
+        except ValueError:
+            print("Amount must be a whole number.")
+            return
+        category = input("Category: ").strip().lower()
+        cadence = input("Repeat daily, weekly, monthly, yearly, or on a cron day pattern (e.g. '1,15 * *'): ")
+        print("First occurrence:")
+        start = get_valid_date()
+        end = input("Last date (YYYY-MM-DD, blank for no end): ").strip() or None
+        note = input("Note (optional): ").strip() or None
+        try:
+            rule_id = add_rule(kind, amount, category, cadence, start, end, note)
+        except ValueError as e:
+            print(e)
+            return
+        print(f"Recurring record #{rule_id} saved, {materialize_rules(user_id=scoped_user())} records written so far.")
+    elif choice == "3":
+        try:
+            rule_id = int(input("Rule number to delete: "))
+        except ValueError:
+            print("Invalid rule number.")
+            return
+        if remove_rule(rule_id):
+            print(f"Rule #{rule_id} deleted. The records it already wrote are kept.")
+        else:
+            print(f"No rule #{rule_id}.")
+    else:
+        print("Invalid input, try again.")
+
 def category_manager():
-    print("1 - Create Categories \n2 - Delete Categories (Expense only)")
-    choice = input("Enter your choice:")
-    if choice == "1":
-        create_categories()
-    elif choice == "2":
-        delete_categories()
-    else:
-        print("Invalid input, try again.")
-        return category_manager
+    print("1 - Create Categories \n2 - Delete Categories (Expense only)")
+    choice = input("Enter your choice:")
+    if choice == "1":
+        create_categories()
+    elif choice == "2":
+        delete_categories()
+    else:
+        print("Invalid input, try again.")
+        return category_manager
 
 
 def input_expense():
-    while True:
-        try:
-            amount = int(input("Input the expense amount: "))
-            if amount <= 0:
-                raise ValueError("Amount must be a positive number.")
-            break  # Exit loop if input is valid
-        except ValueError as e:
-            print(f"Invalid input: {e}. Try again.")
-    expense_category = select_categories()
-    date = get_valid_date() # Get the date as string
-    return {
-        "Amount": amount,
-        "Category": expense_category,
-        "Date": date,
- }
+    while True:
+        try:
+            amount = int(input("Input the expense amount: "))
+            if amount <= 0:
+                raise ValueError("Amount must be a positive number.")
+            break  # Exit loop if input is valid
+        except ValueError as e:
+            print(f"Invalid input: {e}. Try again.")
+    expense_category = select_categories()
+    date = get_valid_date() # Get the date as string
+    return {
+        "Amount": amount,
+        "Category": expense_category,
+        "Date": date,
+        "Note": input("Note (optional): ").strip() or None,
+ }
 
 def input_income():
-    while True:
-        try:
-            amount = int(input("Input the income amount: "))
-            if amount <= 0:
-                raise ValueError("Amount must be a positive number.")
-            break  # Exit loop if input is valid
-        except ValueError as e:
-            print(f"Invalid input: {e}. Try again.")
-    input_category = select_income_cat()
-    date = get_valid_date() # Get the date as string
-    return {
-        "Amount": amount,
-        "Category": input_category,
-        "Date": date,
- }
+    while True:
+        try:
+            amount = int(input("Input the income amount: "))
+            if amount <= 0:
+                raise ValueError("Amount must be a positive number.")
+            break  # Exit loop if input is valid
+        except ValueError as e:
+            print(f"Invalid input: {e}. Try again.")
+    input_category = select_income_cat()
+    date = get_valid_date() # Get the date as string
+    return {
+        "Amount": amount,
+        "Category": input_category,
+        "Date": date,
+        "Note": input("Note (optional): ").strip() or None,
+ }
 def create_categories():
-    category = input("Create a new category: ").strip().lower()
-    conn = sqlite3.connect('expense_tracker.db')  # Reconnect to the database
-    c = conn.cursor()
-    
-    try:
-        # Insert the category into expense_categories
-        c.execute('INSERT INTO expense_categories (category_name) VALUES (?)', (category,))
-        print("Category saved.")
-    except sqlite3.IntegrityError:
-        print("Category already exists. Please use a different name.")
-    finally:
-        conn.close()  # Ensure the connection is closed
-
+    category = input("Create a new category: ").strip().lower()
+
+    try:
+        # Insert the category into expense_categories
+        with transaction() as conn:
+            category_id = conn.execute('INSERT INTO expense_categories (category_name) VALUES (?)', (category,)).lastrowid
+        remember_category("expense", category, category_id)
+        print("Category saved.")
+    except sqlite3.IntegrityError:
+        print("Category already exists. Please use a different name.")
+
+@timed
 def add_expense():
-    expense = input_expense()  # Get the expense data
-    expenses_list.append(expense)
-    print("Expense saved.")
-
-    # Insert into the database
-    conn = sqlite3.connect('expense_tracker.db')
-    c = conn.cursor()
-
-    # Fetch category_id from expense_categories based on selected category
-    c.execute('SELECT id FROM expense_categories WHERE category_name = ?', (expense["Category"],))
-    category_id = c.fetchone()
-    
-    if category_id:
-        c.execute('INSERT INTO expenses (amount, category_id, date, user_id) VALUES (?, ?, ?, ?)', 
-                  (expense["Amount"], category_id[0], expense["Date"], 1))  # Assuming user_id is 1
-        conn.commit()  # Commit the transaction
-    else:
-        print(f"Category {expense['Category']} does not exist in the database.")
-    
-    conn.close()  # Close the connection
-
+    expense = input_expense()  # Get the expense data
+
+    # Queue it for the next group commit and wait for that commit (a few milliseconds)
+    try:
+        if queue_insert("expense", expense["Amount"], expense["Category"], expense["Date"],
+                        note=expense["Note"]).result() is None:
+            print("An identical expense already exists, nothing was saved.")
+        else:
+            print("Expense saved.")
+    except (ValueError, sqlite3.Error) as e:
+        print(e)
+
+@timed
 def add_income():
-    income = input_income()  # Get the income data
-    income_list.append(income)
-    print("Income saved.")
-
-    conn = sqlite3.connect('expense_tracker.db')
-    c = conn.cursor()
-
-    # Fetch category_id from income_categories based on selected category
-    c.execute('SELECT id FROM income_categories WHERE category_name = ?', (income["Category"],))
-    category_id = c.fetchone()
-    
-    if category_id:
-        c.execute('INSERT INTO income (amount, category_id, date, user_id) VALUES (?, ?, ?, ?)', 
-                  (income["Amount"], category_id[0], income["Date"], 1))  # Assuming user_id is 1
-        conn.commit()  # Commit the transaction
-    else:
-        print(f"Category {income['Category']} does not exist in the database.")
-    
-    conn.close()  # Close the connection
+    income = input_income()  # Get the income data
+
+    try:
+        if queue_insert("income", income["Amount"], income["Category"], income["Date"],
+                        note=income["Note"]).result() is None:
+            print("An identical income already exists, nothing was saved.")
+        else:
+            print("Income saved.")
+    except (ValueError, sqlite3.Error) as e:
+        print(e)
+
+# Content hash behind duplicate detection. Two records are duplicates when user, amount,
+# category, date and external reference (a bank transaction id, say) all match.
+def record_hash(user_id: int, amount: int, category_id: int, record_date: str,
+                external_ref: Optional[str] = None) -> bytes:
+    key = f"{user_id}\x1f{amount}\x1f{category_id}\x1f{record_date}\x1f{external_ref or ''}"
+    return hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+
+# Insert one record without prompting; returns the new record id, or None if it's a duplicate
+@timed
+def insert_record(kind: str, amount: int, category: str, date: str, user_id: Optional[int] = None,
+                  external_ref: Optional[str] = None, note: Optional[str] = None) -> Optional[int]:
+    user_id = scoped_user(user_id)
+    table, _ = RECORD_TABLES[kind]
+    if amount <= 0:
+        raise ValueError("Amount must be a positive number.")
+    category_id = category_id_for(kind, category)
+    if category_id is None:
+        raise ValueError(f"Category {category} does not exist in the database.")
+    record_date = parse_date(date)
+    with transaction() as conn:
+        c = conn.execute(f'''INSERT OR IGNORE INTO {table} (amount, category_id, date, user_id, external_ref, content_hash, note)
+                             VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                         (amount, category_id, date_ordinal(record_date), user_id, external_ref,
+                          record_hash(user_id, amount, category_id, record_date, external_ref), note))
+        return c.lastrowid if c.rowcount else None
+
+# Create a category if it doesn't exist yet; returns its id
+def add_category(kind: str, name: str) -> int:
+    category_id = category_id_for(kind, name)
+    if category_id is not None:
+        return category_id
+    _, cat_table = RECORD_TABLES[kind]
+    with transaction() as conn:
+        conn.execute(f'INSERT OR IGNORE INTO {cat_table} (category_name) VALUES (?)', (name,))
+        category_id = conn.execute(f'SELECT id FROM {cat_table} WHERE category_name = ?', (name,)).fetchone()[0]
+    remember_category(kind, name, category_id)
+    return category_id
+
+# Stream rows out of a CSV or JSON-lines file without reading it all into memory.
+# utf-8-sig drops the byte order mark Excel and many banks put before the header.
+# A JSON line that isn't an object comes out as an empty row, which the importer counts as invalid.
+def iter_import_rows(path: str) -> Iterator[dict]:
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        if path.lower().endswith(('.jsonl', '.ndjson', '.json')):
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        row = json.loads(line)
+                    except ValueError:
+                        row = None
+                    yield {str(key).lower(): value for key, value in row.items()} if isinstance(row, dict) else {}
+            return
+
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            return
+        fields = [field.strip().lower() for field in header]
+        if "amount" not in fields:
+            # No header row: columns are amount, category, date (the layout of our own reports)
+            fields = ["amount", "category", "date"]
+            yield dict(zip(fields, header))
+        for values in reader:
+            yield dict(zip(fields, values))
+
+# Bulk import records from a file, one transaction per chunk.
+# Rows already in the database (or repeated in the file) are skipped, so re-importing a statement is harmless.
+@timed
+def import_records(path: str, kind: str, user_id: Optional[int] = None) -> Tuple[int, int]:
+    user_id = scoped_user(user_id)
+    table, _ = RECORD_TABLES[kind]
+    insert_sql = (f'INSERT OR IGNORE INTO {table} (amount, category_id, date, user_id, external_ref, content_hash, note) '
+                  f'VALUES (?, ?, ?, ?, ?, ?, ?)')
+    categories = dict(category_registry(kind))  # Resolved once, then kept up to date as we go
+    imported = invalid = read = 0
+    batch: List[Tuple[int, int, int, int, Optional[str], bytes, Optional[str]]] = []
+    dates: Dict[str, Tuple[str, int]] = {}  # Date as written in the file -> (ISO date, day number); files repeat dates a lot
+    start = time.perf_counter()
+
+    def flush():
+        nonlocal imported
+        with transaction() as conn:
+            imported += conn.executemany(insert_sql, batch).rowcount
+        batch.clear()
+
+    for row in iter_import_rows(path):
+        try:
+            amount = row["amount"]
+            if isinstance(amount, bool) or (isinstance(amount, float) and not amount.is_integer()):
+                raise ValueError  # JSON true or 12.9 would otherwise be stored as 1 or 12
+            amount = int(amount)
+            category = str(row["category"]).strip().lower()
+            raw_date = str(row["date"])
+            parsed = dates.get(raw_date)
+            if parsed is None:
+                record_date = parse_date(raw_date)
+                parsed = dates[raw_date] = (record_date, date.fromisoformat(record_date).toordinal())
+            record_date, day = parsed
+            external_ref = str(row.get("ref") or "").strip() or None  # Optional columns
+            note = str(row.get("note") or "").strip() or None
+            if amount <= 0 or not category:
+                raise ValueError
+        except (KeyError, TypeError, ValueError):
+            invalid += 1
+            continue
+
+        category_id = categories.get(category)
+        if category_id is None:
+            category_id = categories[category] = add_category(kind, category)
+
+        batch.append((amount, category_id, day, user_id, external_ref,
+                      record_hash(user_id, amount, category_id, record_date, external_ref), note))
+        read += 1
+        if len(batch) >= IMPORT_CHUNK_SIZE:
+            flush()
+    if batch:
+        flush()
+
+    elapsed = time.perf_counter() - start
+    rate = read / elapsed if elapsed > 0 else float(read)
+    print(f"Imported {imported} {kind} records ({invalid} invalid, {read - imported} duplicates skipped) "
+          f"in {elapsed:.2f}s, {rate:,.0f} rows/sec.")
+    return imported, invalid + read - imported
+
+def has_records(kind: str, user_id: Optional[int] = None) -> bool:
+    user_id = scoped_user(user_id)
+    table, _ = RECORD_TABLES[kind]
+    c = connect_db().cursor()
+    c.execute(f'SELECT EXISTS (SELECT 1 FROM {table} WHERE user_id = ?)', (user_id,))
+    return bool(c.fetchone()[0])
+
+# Fetch one page of records after a given id (keyset pagination, no OFFSET scans)
+@timed
+def fetch_page(kind: str, after_id: int = 0, limit: int = PAGE_SIZE, user_id: Optional[int] = None) -> List[dict]:
+    user_id = scoped_user(user_id)
+    table, cat_table = RECORD_TABLES[kind]
+    c = connect_db().cursor()
+    c.execute(f'''
+        SELECT {table}.id, {table}.amount, {cat_table}.category_name, {iso_date_sql(f"{table}.date")}, {table}.note
+        FROM {table}
+        JOIN {cat_table} ON {table}.category_id = {cat_table}.id
+        WHERE {table}.user_id = ? AND {table}.id > ?
+        ORDER BY {table}.id
+        LIMIT ?
+    ''', (user_id, after_id, limit))
+    return [
+        {"ID": row[0], "Amount": row[1], "Category": row[2], "Date": row[3], "Note": row[4]}
+        for row in c.fetchall()
+    ]
+
+# Stream every record one page at a time; memory stays bounded by the page size
+def iter_records(kind: str, user_id: Optional[int] = None) -> Iterator[dict]:
+    user_id = scoped_user(user_id)
+    after_id = 0
+    while True:
+        page = fetch_page(kind, after_id, STREAM_PAGE_SIZE, user_id)
+        yield from page
+        if len(page) < STREAM_PAGE_SIZE:
+            return
+        after_id = page[-1]["ID"]
+
+def print_record(label: str, number: int, record: dict):
+    print(f"{label} #{number}:")
+    for key, value in record.items():
+        if value is not None:
+            print(f"  {key}: {value}")
+
+# Page through records on demand, optionally filtered and sorted (see query_records);
+# with select=True the user can pick one and it is returned
+def browse_records(kind: str, label: str, select: bool = False, order: str = "id",
+                   filters: Optional[dict] = None) -> Optional[dict]:
+    after = None
+    number = 0
+    while True:
+        page = query_records(kind, **(filters or {}), order=order, after=after, limit=PAGE_SIZE)
+        if not page:
+            print("No more records." if number else "No matching records found.")
+            return None
+        shown = {}
+        for record in page:
+            number += 1
+            shown[number] = record
+            print_record(label, number, record)
+        after = sort_position(order, page[-1])
+        last_page = len(page) < PAGE_SIZE
+
+        while True:
+            if select:
+                prompt = f"Enter the {label.lower()} record number" + ("" if last_page else ", n for the next page") + " or q to cancel: "
+            elif last_page:
+                return None
+            else:
+                prompt = "n - Next page, q - Stop browsing: "
+            answer = input(prompt).strip().lower()
+            if answer == "q":
+                return None
+            if answer == "n" and not last_page:
+                break
+            if select and answer.isdigit() and int(answer) in shown:
+                return shown[int(answer)]
+            print("Invalid input, try again.")
+
+# Update one record's fields in place; returns False if the record doesn't exist
+@timed
+def update_record(kind: str, record_id: int, amount: Optional[int] = None,
+                  category: Optional[str] = None, date: Optional[str] = None,
+                  user_id: Optional[int] = None, note: Optional[str] = None) -> bool:
+    user_id = scoped_user(user_id)
+    table, _ = RECORD_TABLES[kind]
+    assignments = []
+    params: List[object] = []
+    if amount is not None:
+        if amount <= 0:
+            raise ValueError("Amount must be a positive number.")
+        assignments.append('amount = ?')
+        params.append(amount)
+    if category is not None:
+        category_id = category_id_for(kind, category)
+        if category_id is None:
+            raise ValueError(f"Category {category} does not exist.")
+        assignments.append('category_id = ?')
+        params.append(category_id)
+    if date is not None:
+        assignments.append('date = ?')
+        params.append(date_ordinal(date))
+    if note is not None:
+        assignments.append('note = ?')
+        params.append(note.strip() or None)  # An empty note clears it
+    if not assignments:
+        return False
+
+    with transaction() as conn:
+        c = conn.execute(f'UPDATE {table} SET {", ".join(assignments)} WHERE id = ? AND user_id = ?',
+                         (*params, record_id, user_id))
+        if c.rowcount == 0:
+            return False
+        # Re-hash the edited record; if it now matches another record the edit is rolled back
+        row = conn.execute(f'SELECT amount, category_id, {iso_date_sql("date")}, external_ref FROM {table} WHERE id = ?',
+                           (record_id,)).fetchone()
+        try:
+            conn.execute(f'UPDATE {table} SET content_hash = ? WHERE id = ?',
+                         (record_hash(user_id, *row), record_id))
+        except sqlite3.IntegrityError:
+            raise ValueError("An identical record already exists.")
+        return True
+
+@timed
+def remove_record(kind: str, record_id: int, user_id: Optional[int] = None) -> bool:
+    user_id = scoped_user(user_id)
+    table, _ = RECORD_TABLES[kind]
+    with transaction() as conn:
+        c = conn.execute(f'DELETE FROM {table} WHERE id = ? AND user_id = ?', (record_id, user_id))
+        return c.rowcount > 0
+
+# Remove duplicate records with one pass over the table. Rows without a hash (written before
+# duplicate detection) are hashed oldest first; a row whose
+# hash is already taken duplicates an earlier record and is deleted. The unique index does the
+# matching, so there is no pairwise comparison and memory stays flat. Only user_id's records are
+# touched; None means every user's. Returns the rows removed.
+@timed
+def dedupe_records(kind: str, user_id: Optional[int] = None) -> int:
+    table, _ = RECORD_TABLES[kind]
+    conn = connect_db()
+    user_clause = '' if user_id is None else 'AND user_id = ?'
+    user_params = () if user_id is None else (user_id,)
+    after_id = 0
+    while True:
+        rows = conn.execute(f'''
+            SELECT id, user_id, amount, category_id, {iso_date_sql("date")}, external_ref FROM {table}
+            WHERE content_hash IS NULL AND id > ? {user_clause}
+            ORDER BY id
+            LIMIT ?
+        ''', (after_id, *user_params, DEDUPE_CHUNK_SIZE)).fetchall()
+        if not rows:
+            break
+        with transaction():
+            conn.executemany(f'UPDATE OR IGNORE {table} SET content_hash = ? WHERE id = ?',
+                             [(record_hash(*row[1:]), row[0]) for row in rows])
+        after_id = rows[-1][0]
+    with transaction():
+        return conn.execute(f'DELETE FROM {table} WHERE content_hash IS NULL {user_clause}', user_params).rowcount
+
+# Recurring rules: an amount and category repeated on a cadence from a start date, optionally until
+# an end date. materialize_rules() writes the occurrences due so far as ordinary records. Each one
+# carries the external reference rule:<id>:<day>, so its content hash is unique to that occurrence
+# and a rerun, or two schedulers at once, can't write it twice.
+CADENCES = ("daily", "weekly", "monthly", "yearly")  # Monthly and yearly keep the start's day of month
+CRON_FIELDS = ((1, 31), (1, 12), (0, 7))  # Day of month, month, day of week (0 and 7 are Sunday)
+
+# Values matched by one cron field: "*", "5", "1-5", "1,15", "*/2" or "1-20/5"
+def cron_field(field: str, low: int, high: int) -> set:
+    values = set()
+    for part in field.split(","):
+        spec, _, step = part.partition("/")
+        if spec == "*":
+            first, last = low, high
+        elif "-" in spec:
+            first, last = map(int, spec.split("-", 1))
+        else:
+            first = last = int(spec)
+        if not low <= first <= last <= high or (step and int(step) < 1):
+            raise ValueError(part)
+        values.update(range(first, last + 1, int(step) if step else 1))
+    return values
+
+# A cron day pattern as (days of month, months, weekdays with Sunday = 0, match either day field).
+# As in cron, when both day fields are restricted a day matching either one counts.
+def cron_pattern(cadence: str) -> Tuple[set, set, set, bool]:
+    fields = cadence.split(" ")
+    if len(fields) != 3:
+        raise ValueError(cadence)
+    days, months, weekdays = (cron_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELDS))
+    return days, months, {weekday % 7 for weekday in weekdays}, "*" not in (fields[0][0], fields[2][0])
+
+# Normalize a cadence: one of CADENCES, or a cron pattern. Records are dated by day, so a pattern is
+# day of month, month and day of week; a full five-field cron line has its minute and hour dropped.
+def parse_cadence(cadence: str) -> str:
+    fields = cadence.lower().split()
+    if len(fields) == 1 and fields[0] in CADENCES:
+        return fields[0]
+    pattern = " ".join(fields[2:] if len(fields) == 5 else fields)
+    try:
+        cron_pattern(pattern)
+    except ValueError:
+        raise ValueError(f"Unknown cadence '{cadence}'. Use {', '.join(CADENCES)}, or a cron day pattern "
+                         "such as '1 * *' (day of month, month, day of week).") from None
+    return pattern
+
+# Days of `month` matched by a cron pattern, as offsets from the first of the month
+def cron_month_days(pattern: Tuple[set, set, set, bool], year: int, month: int) -> Tuple[int, ...]:
+    days, months, weekdays, either = pattern
+    if month not in months:
+        return ()
+    first_weekday, length = calendar.monthrange(year, month)  # Monday = 0
+    matches = []
+    for day in range(1, length + 1):
+        in_days = day in days
+        in_weekdays = (first_weekday + day) % 7 in weekdays  # Shifted to cron's Sunday = 0
+        if (in_days or in_weekdays) if either else (in_days and in_weekdays):
+            matches.append(day - 1)
+    return tuple(matches)
+
+# Day numbers from `first` to `last` (inclusive) on which a rule starting on `start` falls.
+# `months` caches cron_month_days() results; rules share a handful of patterns.
+def cadence_days(cadence: str, start: int, first: int, last: int, months: Optional[dict] = None) -> Iterator[int]:
+    first = max(first, start)
+    if cadence == "daily":
+        yield from range(first, last + 1)
+    elif cadence == "weekly":
+        yield from range(first + (start - first) % 7, last + 1, 7)
+    elif cadence in ("monthly", "yearly"):
+        anchor = date.fromordinal(start)
+        begin = date.fromordinal(first)
+        step = 1 if cadence == "monthly" else 12
+        index = (begin.year - anchor.year) * 12 + begin.month - anchor.month
+        index -= index % step  # Months since the start, rounded down to an occurrence
+        while True:
+            year, month = divmod(anchor.year * 12 + anchor.month - 1 + index, 12)
+            if year > MAXYEAR:
+                return
+            day = date(year, month + 1, min(anchor.day, calendar.monthrange(year, month + 1)[1])).toordinal()
+            if day > last:
+                return
+            if day >= first:
+                yield day
+            index += step
+    else:
+        pattern = cron_pattern(cadence)
+        months = {} if months is None else months
+        begin = date.fromordinal(first)
+        year, month = begin.year, begin.month
+        while year <= MAXYEAR:
+            month_start = date(year, month, 1).toordinal()
+            if month_start > last:
+                return
+            offsets = months.get((cadence, year, month))
+            if offsets is None:
+                offsets = months[(cadence, year, month)] = cron_month_days(pattern, year, month)
+            for offset in offsets:
+                if first <= month_start + offset <= last:
+                    yield month_start + offset
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+# Create a recurring rule; returns its id. Its occurrences are written by materialize_rules().
+@timed
+def add_rule(kind: str, amount: int, category: str, cadence: str, start: str, end: Optional[str] = None,
+             note: Optional[str] = None, user_id: Optional[int] = None) -> int:
+    user_id = scoped_user(user_id)
+    if amount <= 0:
+        raise ValueError("Amount must be a positive number.")
+    category_id = category_id_for(kind, category)
+    if category_id is None:
+        raise ValueError(f"Category {category} does not exist in the database.")
+    cadence = parse_cadence(cadence)
+    start_day = date_ordinal(start)
+    end_day = date_ordinal(end) if end else None
+    if end_day is not None and end_day < start_day:
+        raise ValueError("The end date is before the start date.")
+    with transaction() as conn:
+        return conn.execute('''
+            INSERT INTO recurring_rules (user_id, kind, amount, category_id, cadence, start_date, end_date,
+                                         materialized_through, note)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (user_id, kind, amount, category_id, cadence, start_day, end_day, start_day - 1, note)).lastrowid
+
+# A user's rules as (id, kind, amount, category, cadence, start, end, materialized through, note)
+def list_rules(user_id: Optional[int] = None) -> List[tuple]:
+    user_id = scoped_user(user_id)
+    rows = connect_db().execute('''
+        SELECT id, kind, amount, category_id, cadence, start_date, end_date, materialized_through, note
+        FROM recurring_rules WHERE user_id = ? ORDER BY id
+    ''', (user_id,))
+    return [(rule_id, kind, amount, category_name_for(kind, category_id), cadence, ordinal_date(start),
+             ordinal_date(end) if end else None, ordinal_date(through) if through >= start else None, note)
+            for rule_id, kind, amount, category_id, cadence, start, end, through, note in rows]
+
+# Delete a rule; the records it already wrote stay
+@timed
+def remove_rule(rule_id: int, user_id: Optional[int] = None) -> bool:
+    user_id = scoped_user(user_id)
+    with transaction() as conn:
+        return conn.execute('DELETE FROM recurring_rules WHERE id = ? AND user_id = ?',
+                            (rule_id, user_id)).rowcount > 0
+
+# Write every occurrence due up to `through` (default today) for one user's rules, or every user's
+# when user_id is None. One transaction: occurrences stream into executemany() per record table,
+# then each rule's materialized_through moves up. Returns the records written.
+@timed
+def materialize_rules(through: Optional[str] = None, user_id: Optional[int] = None) -> int:
+    horizon = date_ordinal(through) if through else date.today().toordinal()
+    clauses = ['materialized_through < ?', '(end_date IS NULL OR materialized_through < end_date)']
+    params: List[object] = [horizon]
+    if user_id is not None:
+        clauses.append('user_id = ?')
+        params.append(user_id)
+    dates: Dict[int, str] = {}  # Day number -> ISO date for the content hash; rules share days
+    months: dict = {}
+    written = 0
+    with transaction() as conn:
+        rules = conn.execute(f'''
+            SELECT id, user_id, kind, amount, category_id, cadence, start_date, end_date, materialized_through, note
+            FROM recurring_rules
+            WHERE {' AND '.join(clauses)}
+        ''', params).fetchall()
+
+        def occurrences(kind):
+            for rule_id, user, rule_kind, amount, category_id, cadence, start, end, done, note in rules:
+                if rule_kind != kind:
+                    continue
+                last = horizon if end is None else min(horizon, end)
+                for day in cadence_days(cadence, start, done + 1, last, months):
+                    record_date = dates.get(day)
+                    if record_date is None:
+                        record_date = dates[day] = ordinal_date(day)
+                    ref = f"rule:{rule_id}:{day}"
+                    yield (amount, category_id, day, user, ref,
+                           record_hash(user, amount, category_id, record_date, ref), note)
+
+        for kind, (table, _) in RECORD_TABLES.items():
+            written += conn.executemany(
+                f'INSERT OR IGNORE INTO {table} (amount, category_id, date, user_id, external_ref, content_hash, note) '
+                f'VALUES (?, ?, ?, ?, ?, ?, ?)', occurrences(kind)).rowcount
+        conn.executemany('UPDATE recurring_rules SET materialized_through = ? WHERE id = ?',
+                         [(horizon if rule[7] is None else min(horizon, rule[7]), rule[0]) for rule in rules])
+    return written
+
+# Where a record sits in a sort order; pass it back as `after` to get the next page
+def sort_position(order: str, record: dict) -> tuple:
+    column, _ = SORT_ORDERS[order]
+    if column is None:
+        return (record["ID"],)
+    return (record[column.capitalize()], record["ID"])
+
+# Search records in SQL; every filter is optional and they are combined with AND.
+# Results come in `order` (a SORT_ORDERS key), starting after the `after` position, at most `limit`
+# of them. The query walks an index in that order, so a first page or a top-N is quick on any table size.
+@timed
+def query_records(kind: str, user_id: Optional[int] = None, amount: Optional[int] = None,
+                  category: Optional[str] = None, date_from: Optional[str] = None,
+                  date_to: Optional[str] = None, amount_min: Optional[int] = None,
+                  amount_max: Optional[int] = None, order: str = "id", after: Optional[tuple] = None,
+                  limit: Optional[int] = None) -> List[dict]:
+    user_id = scoped_user(user_id)
+    table, cat_table = RECORD_TABLES[kind]
+    column, direction = SORT_ORDERS[order]
+    clauses = [f'{table}.user_id = ?']
+    params: List[object] = [user_id]
+
+    if category is not None:
+        # Resolve the name first so the filter hits the category_id index
+        category_id = category_id_for(kind, category)
+        if category_id is None:
+            return []
+        clauses.append(f'{table}.category_id = ?')
+        params.append(category_id)
+    if amount is not None:
+        clauses.append(f'{table}.amount = ?')
+        params.append(amount)
+    if amount_min is not None:
+        clauses.append(f'{table}.amount >= ?')
+        params.append(amount_min)
+    if amount_max is not None:
+        clauses.append(f'{table}.amount <= ?')
+        params.append(amount_max)
+    if date_from is not None:
+        clauses.append(f'{table}.date >= ?')
+        params.append(date_ordinal(date_from))
+    if date_to is not None:
+        clauses.append(f'{table}.date <= ?')
+        params.append(date_ordinal(date_to))
+
+    # CROSS JOIN fixes the join order so the table whose index matches the sort drives the loop:
+    # the categories (in name order) for a category sort, the records otherwise
+    key = f'{cat_table}.category_name' if column == "category" else f'{table}.{column}'
+    if column == "category":
+        joined = f'{cat_table} CROSS JOIN {table} ON {table}.category_id = {cat_table}.id'
+    else:
+        joined = f'{table} CROSS JOIN {cat_table} ON {table}.category_id = {cat_table}.id'
+    op = '<' if direction == "DESC" else '>'
+    if column is None:
+        order_by = f'{table}.id {direction}'
+        if after is not None:
+            clauses.append(f'{table}.id {op} ?')
+            params.append(after[0])
+    else:
+        order_by = f'{key} {direction}, {table}.id {direction}'
+        if after is not None:
+            if column == "date":
+                after = (date_ordinal(after[0]), after[1])  # Positions carry the ISO date shown to the user
+            # Written so the first comparison can seek the index: key >= last, then skip ties already seen
+            clauses.append(f'{key} {op}= ? AND ({key} {op} ? OR {table}.id {op} ?)')
+            params.extend([after[0], after[0], after[1]])
+
+    c = connect_db().cursor()
+    c.execute(f'''
+        SELECT {table}.id, {table}.amount, {cat_table}.category_name, {iso_date_sql(f"{table}.date")}, {table}.note
+        FROM {joined}
+        WHERE {' AND '.join(clauses)}
+        ORDER BY {order_by}
+        {'LIMIT ?' if limit is not None else ''}
+    ''', params + ([limit] if limit is not None else []))
+    return [
+        {"ID": row[0], "Amount": row[1], "Category": row[2], "Date": row[3], "Note": row[4]}
+        for row in c.fetchall()
+    ]
+
+# Text search over notes (full-text index) and category names. Each word matches as a prefix;
+# with fuzzy on, indexed words within FUZZY_MIN_RATIO similarity count too, so typos still hit.
+FUZZY_MIN_RATIO = 0.75
+FUZZY_MAX_TERMS = 10     # Similar words tried per search word
+
+_search_word = re.compile(r"\w+", re.UNICODE)
+
+# Indexed note words similar to `word`, best first. Only words sharing its first letter and of a
+# similar length are read from the index vocabulary, so this stays a short range scan.
+def similar_terms(kind: str, word: str) -> List[str]:
+    table, _ = RECORD_TABLES[kind]
+    rows = connect_db().execute(f'''
+        SELECT term FROM {table}_fts_vocab
+        WHERE col = 'note' AND term >= ? AND term < ? AND length(term) BETWEEN ? AND ?
+    ''', (word[0], word[0] + "\U0010ffff", len(word) - 2, len(word) + 2)).fetchall()
+    scored = []
+    for (term,) in rows:
+        ratio = difflib.SequenceMatcher(None, word, term).ratio()
+        if ratio >= FUZZY_MIN_RATIO and term != word:
+            scored.append((ratio, term))
+    scored.sort(reverse=True)
+    return [term for _, term in scored[:FUZZY_MAX_TERMS]]
+
+# Ids of the categories whose name contains every word (or, fuzzy, a word close to it)
+def matching_categories(kind: str, words: List[str], fuzzy: bool) -> List[int]:
+    found = []
+    for name, category_id in category_registry(kind).items():
+        name_words = _search_word.findall(name.lower())
+        if all(any(n.startswith(w) or (fuzzy and difflib.SequenceMatcher(None, w, n).ratio() >= FUZZY_MIN_RATIO)
+                   for n in name_words) for w in words):
+            found.append(category_id)
+    return found
+
+# Records whose note or category matches every word of `text`, newest first.
+# Pass the last id seen as before_id for the next page.
+@timed
+def text_search(kind: str, text: str, fuzzy: bool = False, limit: int = PAGE_SIZE,
+                before_id: Optional[int] = None, user_id: Optional[int] = None) -> List[dict]:
+    user_id = scoped_user(user_id)
+    table, cat_table = RECORD_TABLES[kind]
+    words = _search_word.findall(text.lower())
+    if not words:
+        return []
+    before_id = before_id if before_id is not None else 2 ** 63 - 1
+    conn = connect_db()
+    columns = f'{table}.id, {table}.amount, {cat_table}.category_name, {iso_date_sql(f"{table}.date")}, {table}.note'
+
+    groups = []
+    for word in words:
+        terms = [f'"{word}"*'] + ([f'"{t}"' for t in similar_terms(kind, word)] if fuzzy else [])
+        groups.append(f'({" OR ".join(terms)})')
+    # The index drives the query in rowid order, so a page stops after `limit` matches. The user's
+    # own token is part of the match, so other users' notes are skipped inside the index.
+    rows = conn.execute(f'''
+        SELECT {columns}
+        FROM {table}_fts CROSS JOIN {table} ON {table}.id = {table}_fts.rowid
+        JOIN {cat_table} ON {table}.category_id = {cat_table}.id
+        WHERE {table}_fts MATCH ? AND {table}_fts.rowid < ?
+        ORDER BY {table}_fts.rowid DESC
+        LIMIT ?
+    ''', (f'user_id : "{user_id}" AND note : ({" AND ".join(groups)})', before_id, limit)).fetchall()
+
+    # One query per category: each walks the (user_id, category_id) index newest first and stops at `limit`
+    for category_id in matching_categories(kind, words, fuzzy):
+        rows += conn.execute(f'''
+            SELECT {columns}
+            FROM {table} CROSS JOIN {cat_table} ON {table}.category_id = {cat_table}.id
+            WHERE {table}.user_id = ? AND {table}.category_id = ? AND {table}.id < ?
+            ORDER BY {table}.id DESC
+            LIMIT ?
+        ''', (user_id, category_id, before_id, limit)).fetchall()
+
+    merged = sorted({row[0]: row for row in rows}.values(), key=lambda row: row[0], reverse=True)[:limit]
+    return [
+        {"ID": row[0], "Amount": row[1], "Category": row[2], "Date": row[3], "Note": row[4]}
+        for row in merged
+    ]
+
+# Write queue with group commit. Queued inserts, edits and deletes are appended to a journal file
+# next to the database, then committed together once WRITE_BATCH_SIZE are waiting or the oldest
+# has waited WRITE_BATCH_WINDOW seconds. Each queued write returns a Future that resolves (to the
+# write's result) once its batch has committed, so callers can wait for durability or move on.
+# If the process dies first, the journal is replayed the next time the database is opened.
+# Every writing process (a menu session and the API server, say) has a journal of its own, named
+# after it and locked while it runs, and its own committed position in write_journals. A journal
+# is only replayed once its lock is free, that is once the process that wrote it has gone.
+WRITE_BATCH_SIZE = 1000      # Queued writes that trigger a commit...
+WRITE_BATCH_WINDOW = 0.02    # ...or seconds since the oldest was queued, whichever comes first
+JOURNAL_FSYNC = False        # fsync the journal per write; off matches synchronous = NORMAL
+
+_write_queue: List[Tuple[dict, Future]] = []
+_write_queue_cond = threading.Condition()
+_write_queue_since = 0.0     # When the oldest queued write arrived
+_write_seq = 0               # Sequence number of the last write appended to this process's journal
+_journal = None
+_journal_name: Optional[str] = None  # Chosen on the first queued write
+_flusher: Optional[threading.Thread] = None
+_flusher_stopping = False
+_flush_lock = threading.Lock()  # Batches commit one at a time, in journal order
+
+def journal_path(name: str) -> str:
+    return f"{DB_PATH}-writes{name}.jsonl"
+
+def journal_name(path: str) -> str:
+    return path[len(DB_PATH) + len("-writes"):-len(".jsonl")]
+
+# Take the lock on an open journal without waiting; False if another process holds it
+def lock_journal(f) -> bool:
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+# Apply one journaled write on the current transaction
+def apply_write(op: dict):
+    if op["op"] == "insert":
+        return insert_record(op["kind"], op["amount"], op["category"], op["date"], op["user_id"], op.get("ref"),
+                             op.get("note"))
+    if op["op"] == "update":
+        return update_record(op["kind"], op["id"], op.get("amount"), op.get("category"), op.get("date"), op["user_id"],
+                             op.get("note"))
+    if op["op"] == "delete":
+        return remove_record(op["kind"], op["id"], op["user_id"])
+    raise ValueError(f"Unknown write '{op['op']}'.")
+
+# Commit a batch of writes from one journal in one transaction. The record functions run their own
+# nested transaction (a savepoint), so a bad write (unknown category, say) fails alone.
+# The journal position commits with them.
+@timed
+def commit_writes(ops: List[dict], journal: str) -> list:
+    results = []
+    with _write_lock, transaction() as conn:
+        for op in ops:
+            try:
+                results.append(apply_write(op))
+            except (ValueError, sqlite3.IntegrityError) as e:
+                results.append(e)
+        conn.execute('INSERT INTO write_journals (journal, last_seq) VALUES (?, ?) '
+                     'ON CONFLICT (journal) DO UPDATE SET last_seq = excluded.last_seq', (journal, ops[-1]["seq"]))
+    return results
+
+# Replay the journals left by processes that stopped before committing everything, then delete them.
+# Journals still locked belong to running processes (or to another process recovering them) and are
+# left alone. The replay runs under BEGIN IMMEDIATE, so the position it reads can't move underneath it.
+def recover_write_journal():
+    conn = connect_db()
+    for path in sorted(glob.glob(glob.escape(DB_PATH) + "-writes*.jsonl")):
+        name = journal_name(path)
+        if name == _journal_name:
+            continue
+        try:
+            f = open(path, "r+", encoding="utf-8")
+        except FileNotFoundError:
+            continue  # Recovered by another process just now
+        with f:
+            if not lock_journal(f):
+                continue
+            f.seek(0)
+            ops, failed_seqs = [], set()
+            for line in f:
+                try:
+                    op = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # A write cut off mid-line by the crash was never acknowledged
+                if "failed" in op:
+                    failed_seqs.update(op["failed"])  # Reported to the caller as failed; never replayed
+                else:
+                    ops.append(op)
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT last_seq FROM write_journals WHERE journal = ?', (name,)).fetchone()
+                pending = [op for op in ops if op["seq"] > (row[0] if row else 0) and op["seq"] not in failed_seqs]
+                results = commit_writes(pending, name) if pending else []
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+            if pending:
+                failed = sum(isinstance(result, Exception) for result in results)
+                print(f"Recovered {len(pending) - failed} queued writes from {path}"
+                      + (f" ({failed} could not be applied)." if failed else "."), file=sys.stderr)
+            os.remove(path)  # Still locked by us, so nobody else is replaying it
+        with transaction():
+            conn.execute('DELETE FROM write_journals WHERE journal = ?', (name,))  # Names are never reused
+
+# Start this process's journal, locked until the process exits or the journal is emptied
+def open_journal():
+    global _journal, _journal_name
+    if _journal_name is None:
+        _journal_name = f"-{os.getpid()}-{secrets.token_hex(4)}"
+    _journal = open(journal_path(_journal_name), "a", encoding="utf-8")
+    lock_journal(_journal)
+
+# Queue a write; the returned Future's result is what the direct call would have returned
+def queue_write(op: str, kind: str, **fields) -> Future:
+    global _journal, _write_seq, _write_queue_since
+    if kind not in RECORD_TABLES:
+        raise ValueError(f"Unknown kind '{kind}'.")
+    entry = {"op": op, "kind": kind, "user_id": scoped_user(fields.pop("user_id", None)), **fields}
+    future: Future = Future()
+    with _write_queue_cond:
+        start_flusher()
+        _write_seq += 1
+        entry["seq"] = _write_seq
+        if _journal is None:
+            open_journal()
+        _journal.write(json.dumps(entry) + "\n")
+        _journal.flush()
+        if JOURNAL_FSYNC:
+            os.fsync(_journal.fileno())
+        if not _write_queue:
+            _write_queue_since = time.monotonic()
+        _write_queue.append((entry, future))
+        if len(_write_queue) in (1, WRITE_BATCH_SIZE):
+            _write_queue_cond.notify()  # Start the window, or end it early
+    return future
+
+def queue_insert(kind: str, amount: int, category: str, date: str, user_id: Optional[int] = None,
+                 external_ref: Optional[str] = None, note: Optional[str] = None) -> Future:
+    if amount <= 0:
+        raise ValueError("Amount must be a positive number.")
+    return queue_write("insert", kind, amount=amount, category=category, date=parse_date(date),
+                       user_id=user_id, ref=external_ref, note=note)
+
+def queue_update(kind: str, record_id: int, amount: Optional[int] = None, category: Optional[str] = None,
+                 date: Optional[str] = None, user_id: Optional[int] = None, note: Optional[str] = None) -> Future:
+    return queue_write("update", kind, id=record_id, amount=amount, category=category,
+                       date=parse_date(date) if date is not None else None, user_id=user_id, note=note)
+
+def queue_delete(kind: str, record_id: int, user_id: Optional[int] = None) -> Future:
+    return queue_write("delete", kind, id=record_id, user_id=user_id)
+
+# Commit everything queued so far; returns the number of writes committed
+def flush_writes() -> int:
+    with _flush_lock:
+        with _write_queue_cond:
+            batch = _write_queue[:]
+            _write_queue.clear()
+        if not batch:
+            return 0
+        try:
+            results = commit_writes([entry for entry, _ in batch], _journal_name)
+        except sqlite3.Error as e:
+            # Reported as failed, so mark them in the journal: a replay must not apply them after all
+            with _write_queue_cond:
+                _journal.write(json.dumps({"failed": [entry["seq"] for entry, _ in batch]}) + "\n")
+                _journal.flush()
+            for _, future in batch:
+                future.set_exception(e)
+            return 0
+    for (_, future), result in zip(batch, results):
+        if isinstance(result, Exception):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+    with _write_queue_cond:
+        if not _write_queue and _journal is not None:
+            # Everything journaled is committed: empty the journal, keeping it open and locked
+            _journal.seek(0)
+            _journal.truncate()
+    return len(batch)
+
+def flush_loop():
+    while True:
+        with _write_queue_cond:
+            while not _write_queue and not _flusher_stopping:
+                _write_queue_cond.wait()
+            if not _write_queue:
+                return
+            while len(_write_queue) < WRITE_BATCH_SIZE and not _flusher_stopping:
+                remaining = _write_queue_since + WRITE_BATCH_WINDOW - time.monotonic()
+                if remaining <= 0:
+                    break
+                _write_queue_cond.wait(remaining)
+        flush_writes()
+
+def start_flusher():
+    global _flusher, _flusher_stopping
+    if _flusher is None:
+        _flusher_stopping = False
+        _flusher = threading.Thread(target=flush_loop, name="write-flusher", daemon=True)
+        _flusher.start()
+        atexit.register(stop_flusher)
+
+# Commit whatever is still queued and stop the flusher thread
+def stop_flusher():
+    global _flusher, _flusher_stopping, _journal
+    if _flusher is None:
+        return
+    with _write_queue_cond:
+        _flusher_stopping = True
+        _write_queue_cond.notify()
+    _flusher.join()
+    _flusher = None
+    flush_writes()
+    if _journal is not None and _journal.tell() == 0:
+        # All committed, so this process's journal and its position can go
+        _journal.close()
+        _journal = None
+        try:
+            os.remove(journal_path(_journal_name))
+        except FileNotFoundError:
+            pass  # Another process starting up found it empty and removed it first
+        with transaction() as conn:
+            conn.execute('DELETE FROM write_journals WHERE journal = ?', (_journal_name,))
+
+@timed
+def import_menu():
+    print("1 - Import Expenses \n2 - Import Incomes")
+    choice = input("Enter your choice:").strip()
+    if choice not in ("1", "2"):
+        print("Invalid input, try again.")
+        return import_menu()
+    kind = "expense" if choice == "1" else "income"
+    path = input("Path to the CSV or JSON-lines file: ").strip()
+    try:
+        import_records(path, kind)
+    except OSError as e:
+        print(f"Could not read '{path}': {e}")
+    except (sqlite3.Error, json.JSONDecodeError) as e:
+        print(f"An error occurred during import: {e}")
 
 def delete_categories():
-    if not category_list:
-        print("No categories yet.")
-        return
-    
-    print("Select a category to delete:")
-    for index, category in enumerate(category_list, start=1):
-        print(f"Category #{index}: {category}")
-    
-    selected_index = int(input("Enter the category number:"))
-    
-    if 1 <= selected_index <= len(category_list):
-        deleted_category = category_list[selected_index - 1]
-        confirmation = input(f"Are you sure you want to delete the category '{deleted_category}'? (y/n): ").lower().strip()
-        
-        if confirmation != 'y':
-            print("Category deletion aborted.")
-            return
-        
-        category_list.remove(deleted_category)
-        conn = sqlite3.connect('expense_tracker.db')
-        c = conn.cursor()
-        
-        # Update any entries in the expenses table to 'Uncategorized'
-        uncategorized = 'Uncategorized'
-        c.execute('UPDATE expenses SET category_id = (SELECT id FROM expense_categories WHERE category_name = ?), date = ? WHERE category_id = (SELECT id FROM expense_categories WHERE category_name = ?)', 
-                  (uncategorized, uncategorized, deleted_category))
-        
-        # Delete category from the categories table
-        c.execute('DELETE FROM expense_categories WHERE category_name = ?', (deleted_category,))
-        
-        conn.commit()  # Commit the transaction
-        conn.close()
-
-        print(f"Category '{deleted_category}' deleted, and all records with this category have been updated to '{uncategorized}'.")
-    else:
-        print("Invalid selection. Please try again.")
+    if not is_admin():
+        print("Categories are shared by every user, so only an admin can delete them.")
+        return
+    category_list = [name for name in category_names("expense") if name != UNCATEGORIZED]
+    if not category_list:
+        print("No categories yet.")
+        return
+    
+    print("Select a category to delete:")
+    for index, category in enumerate(category_list, start=1):
+        print(f"Category #{index}: {category}")
+    
+    selected_index = int(input("Enter the category number:"))
+    
+    if 1 <= selected_index <= len(category_list):
+        deleted_category = category_list[selected_index - 1]
+        confirmation = input(f"Are you sure you want to delete the category '{deleted_category}'? (y/n): ").lower().strip()
+        
+        if confirmation != 'y':
+            print("Category deletion aborted.")
+            return
+        
+        uncategorized = UNCATEGORIZED
+        with transaction() as conn:
+            c = conn.cursor()
+
+            # Update any entries in the expenses table to 'Uncategorized'. They keep the hash they were
+            # written with: records from two deleted categories can end up identical, and dedupe
+            # must not take them for duplicates.
+            c.execute('UPDATE expenses SET category_id = ? WHERE category_id = ?',
+                      (add_category("expense", uncategorized), category_id_for("expense", deleted_category)))
+            c.execute("UPDATE recurring_rules SET category_id = ? WHERE kind = 'expense' AND category_id = ?",
+                      (category_id_for("expense", uncategorized), category_id_for("expense", deleted_category)))
+
+            # Delete category from the categories table
+            c.execute('DELETE FROM expense_categories WHERE category_name = ?', (deleted_category,))
+        forget_category("expense", deleted_category)
+
+        print(f"Category '{deleted_category}' deleted, and all records with this category have been updated to '{uncategorized}'.")
+    else:
+        print("Invalid selection. Please try again.")
 
 def select_categories():
-    if not category_list:
-        print("No categories yet. Create one first.")
-        create_categories()
-        return select_categories()  # Recursively call after creating
-
-    for index, category in enumerate(category_list, start=1):
-        print(f"Category #{index}: {category}")
-
-    selected_input = input("Enter the category number or 'c' to create: ")
-
-    if selected_input.lower() == 'c':
-        create_categories()
-        return select_categories()  # After creating a category, return to selection
-
-    try:
-        selected_index = int(selected_input)  # converting input to an integer
-        if 1 <= selected_index <= len(category_list):
-            selected_category = category_list[selected_index - 1]
-            print(f"You selected: {selected_category}")
-            return selected_category
-        else:
-            print("Invalid selection. Please try again.")
-            return select_categories()
-    except ValueError:
-        print("Invalid input. Please enter a number or 'c' to create a category.")
-        return select_categories()
+    category_list = category_names("expense")
+    if not category_list:
+        print("No categories yet. Create one first.")
+        create_categories()
+        return select_categories()  # Recursively call after creating
+
+    for index, category in enumerate(category_list, start=1):
+        print(f"Category #{index}: {category}")
+
+    selected_input = input("Enter the category number or 'c' to create: ")
+
+    if selected_input.lower() == 'c':
+        create_categories()
+        return select_categories()  # After creating a category, return to selection
+
+    try:
+        selected_index = int(selected_input)  # converting input to an integer
+        if 1 <= selected_index <= len(category_list):
+            selected_category = category_list[selected_index - 1]
+            print(f"You selected: {selected_category}")
+            return selected_category
+        else:
+            print("Invalid selection. Please try again.")
+            return select_categories()
+    except ValueError:
+        print("Invalid input. Please enter a number or 'c' to create a category.")
+        return select_categories()
 
 #end
 
 def select_income_cat():
-    # Display available categories to the user
-    print("Please select an income category from the following options:")
-    for idx, category in enumerate(income_cat_list):
-        print(f"{idx + 1}. {category}")
-    
-    # Loop until a valid category is selected
-    while True:
-        try:
-            # Get user input for category selection
-            selected = int(input("Enter the number corresponding to your category: "))
-            
-            # Check if the selection is within the valid range
-            if 1 <= selected <= len(income_cat_list):
-                print(f"You have selected: {income_cat_list[selected - 1]}")
-                return income_cat_list[selected - 1]  # Return the selected category
-            else:
-                print("Invalid selection. Please choose a number from the list.")
-        except ValueError:
-            # Handle non-integer inputs
-            print("Please enter a valid number.")
-def total_expense():
-    total_exp = 0
-    for expense in expenses_list:
-        amount = expense["Amount"]
-        if amount is not None:
-            total_exp += expense["Amount"]
-    return total_exp
-
-def total_income():
-    total_inc = 0 # Fixed typo here
-    for income in income_list:
-        amount = income["Amount"]
-        if amount is not None:
-            total_inc += income["Amount"]
-    return total_inc
+    # Display available categories to the user
+    income_cat_list = category_names("income")
+    print("Please select an income category from the following options:")
+    for idx, category in enumerate(income_cat_list):
+        print(f"{idx + 1}. {category}")
+    
+    # Loop until a valid category is selected
+    while True:
+        try:
+            # Get user input for category selection
+            selected = int(input("Enter the number corresponding to your category: "))
+            
+            # Check if the selection is within the valid range
+            if 1 <= selected <= len(income_cat_list):
+                print(f"You have selected: {income_cat_list[selected - 1]}")
+                return income_cat_list[selected - 1]  # Return the selected category
+            else:
+                print("Invalid selection. Please choose a number from the list.")
+        except ValueError:
+            # Handle non-integer inputs
+            print("Please enter a valid number.")
+# Read a user's (expenses, income, revenue) totals from the trigger-maintained total table
+@timed
+def get_totals(user_id: Optional[int] = None) -> Tuple[int, int, int]:
+    user_id = scoped_user(user_id)
+    c = connect_db().cursor()
+    c.execute('SELECT totalexp, totalinc, totalrev FROM total WHERE user_id = ?', (user_id,))
+    row = c.fetchone()
+    return (row[0], row[1], row[2]) if row else (0, 0, 0)
+
+# Compare the total table against a full recount; with repair=True, rebuild it from scratch
+@timed
+def check_totals(repair: bool = True) -> List[int]:
+    c = connect_db().cursor()
+    c.execute(f'''
+        WITH fresh AS ({FRESH_TOTALS_SQL})
+        SELECT fresh.user_id FROM fresh
+        LEFT JOIN total ON total.user_id = fresh.user_id
+        WHERE total.user_id IS NULL
+           OR total.totalexp != fresh.totalexp
+           OR total.totalinc != fresh.totalinc
+           OR total.totalrev != fresh.totalrev
+        UNION
+        SELECT total.user_id FROM total
+        LEFT JOIN fresh ON fresh.user_id = total.user_id
+        WHERE fresh.user_id IS NULL AND (total.totalexp != 0 OR total.totalinc != 0 OR total.totalrev != 0)
+    ''')
+    mismatched = [row[0] for row in c.fetchall()]
+    if mismatched and repair:
+        with transaction() as conn:
+            conn.execute('DELETE FROM total')
+            conn.execute(f'INSERT INTO total (user_id, totalexp, totalinc, totalrev) {FRESH_TOTALS_SQL}')
+    return mismatched
+
+def verify_totals():
+    mismatched = check_totals(repair=not READ_ONLY)
+    if mismatched and READ_ONLY:
+        print(f"Totals are out of date for {len(mismatched)} user(s). Open the tracker without --read-only to rebuild them.")
+    elif mismatched:
+        print(f"Totals were out of date for {len(mismatched)} user(s) and have been rebuilt.")
+    else:
+        print("Totals are consistent.")
+
+# Stream records straight from a cursor into a CSV (optionally gzip) file; returns rows written
+@timed
+def export_csv(kind: str, path: str, date_from: Optional[str] = None, date_to: Optional[str] = None,
+               compress: bool = False, user_id: Optional[int] = None) -> int:
+    user_id = scoped_user(user_id)
+    table, cat_table = RECORD_TABLES[kind]
+    clauses = [f'{table}.user_id = ?']
+    params: List[object] = [user_id]
+    if date_from is not None:
+        clauses.append(f'{table}.date >= ?')
+        params.append(date_ordinal(date_from))
+    if date_to is not None:
+        clauses.append(f'{table}.date <= ?')
+        params.append(date_ordinal(date_to))
+
+    c = connect_db().cursor()
+    # (user_id, date) index order, so SQLite never has to sort the result in memory
+    c.execute(f'''
+        SELECT {table}.amount, {cat_table}.category_name, {iso_date_sql(f"{table}.date")}
+        FROM {table}
+        JOIN {cat_table} ON {table}.category_id = {cat_table}.id
+        WHERE {' AND '.join(clauses)}
+        ORDER BY {table}.date, {table}.id
+    ''', params)
+
+    if compress:
+        f = gzip.open(path, "wt", newline="", encoding="utf-8")
+    else:
+        f = open(path, "w", newline="", encoding="utf-8", buffering=EXPORT_BUFFER_SIZE)
+    written = 0
+    with f:
+        writer = csv.writer(f)
+        writer.writerow(["Amount", "Category", "Date"])
+        while True:
+            rows = c.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            writer.writerows(rows)
+            written += len(rows)
+    return written
+
+def export_totals_csv(path: str, user_id: Optional[int] = None):
+    totalexp, totalinc, totalrev = get_totals(user_id)
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Total expenses", totalexp])
+        writer.writerow(["Total income", totalinc])
+        writer.writerow(["Total", totalrev])
+
+# Ask whether to write a CSV file and where; returns the path or None
+def prompt_csv_path(default_path: str) -> Optional[str]:
+    while True:
+        cvs = input("Do you want to print the report in CVS? (y/n)\nEnter your choice: ")
+        if cvs.strip().lower() == "y":
+            path = input(f"Output file [{default_path}] (end it with .gz to compress): ").strip()
+            return path or default_path
+        elif cvs.strip().lower() == "n":
+            print("")
+            return None
+        print("Invalid input, try again.")
+
+# Ask for an optional date range; blank answers leave that end open
+def prompt_date_range() -> Tuple[Optional[str], Optional[str]]:
+    bounds = []
+    for label in ("From", "To"):
+        while True:
+            date_str = input(f"{label} date (YYYY-MM-DD, blank for no limit): ").strip()
+            if not date_str:
+                bounds.append(None)
+                break
+            try:
+                bounds.append(parse_date(date_str))
+                break
+            except ValueError:
+                print("Invalid date format. Please enter the date in YYYY-MM-DD or YYYY/MM/DD format.")
+    return bounds[0], bounds[1]
+
+def cvs_records(kind: str, default_path: str):
+    path = prompt_csv_path(default_path)
+    if path is None:
+        return
+    date_from, date_to = prompt_date_range()
+    try:
+        written = export_csv(kind, path, date_from, date_to, compress=path.endswith(".gz"))
+        print(f"{written} records written to {path}.")
+    except OSError as e:
+        print(f"Could not write '{path}': {e}")
 
 def cvs_expense():
-    cvs = input("Do you want to print the report in CVS? (y/n)\nEnter your choice: ")
-    if cvs.strip().lower() == "y":
-        with open("expense_report.csv", "w") as f:
-            for expense in expenses_list:
-                f.write(f"{expense['Amount']},{expense['Category']},{expense['Date']}\n")
-    elif cvs.strip().lower() == "n":
-            print("")
-    else:
-        print("Invalid input, try again.")
-        return cvs_expense()
+    cvs_records("expense", "expense_report.csv")
 
 def cvs_income():
-    cvs = input("Do you want to print the report in CVS? (y/n)\nEnter your choice: ")
-    if cvs.strip().lower() == "y":
-        with open("income_report.csv", "w") as f:
-            for income in income_list:
-                f.write(f"{income['Amount']},{income['Category']},{income['Date']}\n")
-    elif cvs.strip().lower() == "n":
-            print("")
-    else:
-        print("Invalid input, try again.")
-        return cvs_income()
+    cvs_records("income", "income_report.csv")
 
 def cvs_total():
-    cvs = input("Do you want to print the report in CVS? (y/n)\nEnter your choice: ")
-    if cvs.strip().lower() == "y":
-        with open("total_report.csv", "w") as f:
-            f.write(f"Total expenses: {total_expense()}\n")
-            f.write(f"Total income: {total_income()}\n")
-            f.write(f"Total: {total_income() - total_expense()}\n")
-    elif cvs.strip().lower() == "n":
-            print("")
-    else:
-        print("Invalid input, try again.")
-        return cvs_total()
+    path = prompt_csv_path("total_report.csv")
+    if path is None:
+        return
+    try:
+        export_totals_csv(path)
+        print(f"Totals written to {path}.")
+    except OSError as e:
+        print(f"Could not write '{path}': {e}")
+# Batch report run: a user's records (or, for an admin, every user's) as one CSV per kind and month,
+# plus a totals file per user, under <directory>/user-<id>/. The files are written by a pool of worker processes, each reading
+# through its own read-only connection (WAL lets them all read alongside a writer).
+REPORT_PROGRESS_INTERVAL = 0.5  # Seconds between progress updates
+
+# Runs once in each worker process
+def start_report_worker(db_path: str):
+    global DB_PATH
+    DB_PATH = db_path
+    _read_conn.set(connect_readonly())  # connect_db() now returns it; the parent's connection is never touched
+
+# The work to do: (rows, kind, user_id, month) for every user and month with records
+# user_id None means every user
+def report_tasks(date_from: Optional[str] = None, date_to: Optional[str] = None,
+                 user_id: Optional[int] = None) -> List[Tuple[int, str, int, str]]:
+    conn = connect_db()
+    tasks = []
+    for kind, (table, _) in RECORD_TABLES.items():
+        where, params = ['1'], []
+        if user_id is not None:
+            where.append('user_id = ?')
+            params.append(user_id)
+        if date_from is not None:
+            where.append('date >= ?')
+            params.append(date_ordinal(date_from))
+        if date_to is not None:
+            where.append('date <= ?')
+            params.append(date_ordinal(date_to))
+        rows = conn.execute(f'''
+            SELECT COUNT(*), user_id, strftime('%Y-%m', date + {JULIAN_DAY_OFFSET}) AS month
+            FROM {table}
+            WHERE {' AND '.join(where)}
+            GROUP BY user_id, month
+        ''', params)
+        tasks.extend((count, kind, user_id, month) for count, user_id, month in rows)
+    return tasks
+
+def user_report_dir(directory: str, user_id: int) -> str:
+    path = os.path.join(directory, f"user-{user_id}")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+# Worker task: one user's records of one kind for one month; returns rows written
+def write_month_report(directory: str, kind: str, user_id: int, month: str,
+                       date_from: Optional[str] = None, date_to: Optional[str] = None) -> int:
+    month_from, month_to = period_bounds(month)
+    path = os.path.join(user_report_dir(directory, user_id), f"{month}-{RECORD_TABLES[kind][0]}.csv")
+    return export_csv(kind, path, max(month_from, date_from or month_from), min(month_to, date_to or month_to),
+                      user_id=user_id)
+
+# Worker task: one user's totals file
+def write_user_totals(directory: str, user_id: int) -> int:
+    export_totals_csv(os.path.join(user_report_dir(directory, user_id), "totals.csv"), user_id)
+    return 0
+
+def print_report_progress(done: int, files: int, rows: int, total_rows: int, started: float):
+    elapsed = time.perf_counter() - started
+    share = rows / total_rows if total_rows else done / files
+    left = f", about {elapsed * (1 - share) / share:.0f}s left" if 0 < share < 1 else ""
+    print(f"\r{done}/{files} files, {rows:,}/{total_rows:,} rows ({share:.0%}), {elapsed:.1f}s{left}   ",
+          end="", file=sys.stderr, flush=True)
+
+# Write the current user's batch reports (every user's with all_users, admins only) with `workers`
+# processes (default: one per CPU). Tasks go out largest first, so the run doesn't end waiting on
+# one big file. Returns (files, rows) written.
+def run_batch_reports(directory: str, workers: Optional[int] = None, date_from: Optional[str] = None,
+                      date_to: Optional[str] = None, progress: bool = True,
+                      all_users: bool = False) -> Tuple[int, int]:
+    from concurrent.futures import ProcessPoolExecutor  # Pulls in multiprocessing, so only imported here
+    if all_users:
+        require_admin("export every user's reports")
+    tasks = sorted(report_tasks(date_from, date_to, None if all_users else scoped_user()), reverse=True)
+    users = sorted({user_id for _, _, user_id, _ in tasks})
+    total_rows = sum(count for count, _, _, _ in tasks)
+    os.makedirs(directory, exist_ok=True)
+    started = time.perf_counter()
+    last_update = 0.0
+    done = rows = 0
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=start_report_worker,
+                               initargs=(os.path.abspath(DB_PATH),))
+    try:
+        futures = [pool.submit(write_month_report, directory, kind, user_id, month, date_from, date_to)
+                   for _, kind, user_id, month in tasks]
+        futures += [pool.submit(write_user_totals, directory, user_id) for user_id in users]
+        for future in as_completed(futures):
+            rows += future.result()
+            done += 1
+            if progress and (time.perf_counter() - last_update >= REPORT_PROGRESS_INTERVAL or done == len(futures)):
+                last_update = time.perf_counter()
+                print_report_progress(done, len(futures), rows, total_rows, started)
+    finally:
+        pool.shutdown(cancel_futures=True)  # After a failure, drop the tasks not started yet
+        if progress and done:
+            print(file=sys.stderr)  # End the progress line
+    return done, rows
+
+# Import pyarrow on first use; returns False if it isn't installed
+def import_pyarrow() -> bool:
+    global pa, pq
+    if pa is None:
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            return False
+        pa, pq = pyarrow, pyarrow.parquet
+    return True
+
+# Write a columnar snapshot of one record table as a Parquet file under <directory>/<table>/;
+# returns rows written. With incremental=True only rows newer than the previous export to the same
+# directory are written, each run adding a new part file so the folder reads as one dataset.
+@timed
+def export_parquet(kind: str, directory: str, incremental: bool = True, user_id: Optional[int] = None) -> int:
+    user_id = scoped_user(user_id)
+    if READ_ONLY:
+        raise RuntimeError("Parquet export records its progress in the database, so it can't run read-only.")
+    if not import_pyarrow():
+        raise RuntimeError("Parquet export needs the pyarrow package (pip install pyarrow).")
+    table, cat_table = RECORD_TABLES[kind]
+    directory = os.path.join(directory, table, f"user-{user_id}")
+    target = f"parquet:{os.path.abspath(directory)}"  # One directory, and one high-water mark, per user
+    schema = pa.schema([
+        ("id", pa.int64()),
+        ("user_id", pa.int64()),
+        ("amount", pa.int64()),
+        ("category", pa.dictionary(pa.int32(), pa.string())),
+        ("date", pa.date32()),
+    ])
+
+    conn = connect_db()
+    last_id = 0
+    if incremental:
+        row = conn.execute('SELECT last_id FROM export_state WHERE target = ?', (target,)).fetchone()
+        last_id = row[0] if row else 0
+
+    c = conn.cursor()
+    c.execute(f'''
+        SELECT {table}.id, {table}.user_id, {table}.amount, {cat_table}.category_name,
+               {table}.date - {UNIX_EPOCH_DAY}
+        FROM {table}
+        JOIN {cat_table} ON {table}.category_id = {cat_table}.id
+        WHERE {table}.user_id = ? AND {table}.id > ?
+        ORDER BY {table}.id
+    ''', (user_id, last_id))
+
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f".part-{last_id + 1:012d}.parquet.tmp")
+    written = 0
+    first_id = max_id = None
+    writer = None
+    try:
+        while True:
+            rows = c.fetchmany(PARQUET_ROW_GROUP_SIZE)
+            if not rows:
+                break
+            ids, user_ids, amounts, categories, days = zip(*rows)
+            batch = pa.record_batch([
+                pa.array(ids, pa.int64()),
+                pa.array(user_ids, pa.int64()),
+                pa.array(amounts, pa.int64()),
+                pa.array(categories, pa.string()).dictionary_encode(),
+                pa.array(days, pa.int32()).cast(pa.date32()),
+            ], schema=schema)
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, schema)
+            writer.write_batch(batch, row_group_size=PARQUET_ROW_GROUP_SIZE)
+            written += len(rows)
+            first_id = ids[0] if first_id is None else first_id
+            max_id = ids[-1]
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if written == 0:
+        return 0
+    # Only publish the file and move the high-water mark once the file is complete
+    if not incremental:
+        # A full snapshot replaces the earlier parts instead of duplicating their rows
+        for name in os.listdir(directory):
+            if name.startswith("part-") and name.endswith(".parquet"):
+                os.remove(os.path.join(directory, name))
+    os.replace(tmp_path, os.path.join(directory, f"part-{first_id:012d}-{max_id:012d}.parquet"))
+    with transaction() as conn:
+        conn.execute('''
+            INSERT INTO export_state (target, last_id) VALUES (?, ?)
+            ON CONFLICT (target) DO UPDATE SET last_id = excluded.last_id
+        ''', (target, max_id))
+    return written
+
+def parquet_report():
+    directory = input("Export directory [parquet_export]: ").strip() or "parquet_export"
+    incremental = input("Only export records added since the last export? (y/n): ").strip().lower() != "n"
+    for kind in RECORD_TABLES:
+        try:
+            written = export_parquet(kind, directory, incremental)
+        except (RuntimeError, OSError) as e:
+            print(f"Parquet export failed: {e}")
+            return
+        print(f"{written} {kind} records exported to {directory}.")
+
+# Build the WHERE clause shared by the summary reports
+def report_filters(table: str, user_id: Optional[int], date_from: Optional[str],
+                   date_to: Optional[str]) -> Tuple[str, List[object]]:
+    user_id = scoped_user(user_id)
+    clauses = [f'{table}.user_id = ?']
+    params: List[object] = [user_id]
+    if date_from is not None:
+        clauses.append(f'{table}.date >= ?')
+        params.append(date_ordinal(date_from))
+    if date_to is not None:
+        clauses.append(f'{table}.date <= ?')
+        params.append(date_ordinal(date_to))
+    return ' AND '.join(clauses), params
+
+# Totals per period and category, aggregated in SQLite over the covering (user_id, date, ...) index
+@timed
+def period_category_totals(kind: str, period: str = "month", user_id: Optional[int] = None,
+                           date_from: Optional[str] = None,
+                           date_to: Optional[str] = None) -> List[Tuple[str, str, int]]:
+    table, cat_table = RECORD_TABLES[kind]
+    where, params = report_filters(table, user_id, date_from, date_to)
+    c = connect_db().cursor()
+    c.execute(f'''
+        SELECT sums.period, {cat_table}.category_name, sums.total
+        FROM (
+            SELECT strftime(?, {table}.date + {JULIAN_DAY_OFFSET}) AS period, {table}.category_id, SUM({table}.amount) AS total
+            FROM {table}
+            WHERE {where}
+            GROUP BY period, {table}.category_id
+        ) AS sums
+        JOIN {cat_table} ON sums.category_id = {cat_table}.id
+        ORDER BY sums.period, sums.total DESC
+    ''', [PERIOD_FORMATS[period], *params])
+    return c.fetchall()
+
+# Income, expenses and net revenue per period
+@timed
+def net_revenue_by_period(period: str = "month", user_id: Optional[int] = None, date_from: Optional[str] = None,
+                          date_to: Optional[str] = None) -> List[Tuple[str, int, int, int]]:
+    exp_where, exp_params = report_filters("expenses", user_id, date_from, date_to)
+    inc_where, inc_params = report_filters("income", user_id, date_from, date_to)
+    pattern = PERIOD_FORMATS[period]
+    c = connect_db().cursor()
+    c.execute(f'''
+        SELECT period, SUM(inc), SUM(exp), SUM(inc) - SUM(exp)
+        FROM (
+            SELECT strftime(?, date + {JULIAN_DAY_OFFSET}) AS period, 0 AS inc, SUM(amount) AS exp
+            FROM expenses WHERE {exp_where} GROUP BY period
+            UNION ALL
+            SELECT strftime(?, date + {JULIAN_DAY_OFFSET}) AS period, SUM(amount) AS inc, 0 AS exp
+            FROM income WHERE {inc_where} GROUP BY period
+        )
+        GROUP BY period
+        ORDER BY period
+    ''', [pattern, *exp_params, pattern, *inc_params])
+    return c.fetchall()
+
+# The n categories with the largest totals
+@timed
+def top_categories(kind: str, n: int = 5, user_id: Optional[int] = None, date_from: Optional[str] = None,
+                   date_to: Optional[str] = None) -> List[Tuple[str, int]]:
+    table, cat_table = RECORD_TABLES[kind]
+    where, params = report_filters(table, user_id, date_from, date_to)
+    c = connect_db().cursor()
+    c.execute(f'''
+        SELECT {cat_table}.category_name, sums.total
+        FROM (
+            SELECT {table}.category_id, SUM({table}.amount) AS total
+            FROM {table}
+            WHERE {where}
+            GROUP BY {table}.category_id
+        ) AS sums
+        JOIN {cat_table} ON sums.category_id = {cat_table}.id
+        ORDER BY sums.total DESC
+        LIMIT ?
+    ''', [*params, n])
+    return c.fetchall()
+
+@timed
+def summary_report():
+    print("Would you like to see:\n1 - Monthly totals per category\n2 - Weekly totals per category"
+          "\n3 - Net revenue per month\n4 - Top categories")
+    choice = input("Enter your choice:").strip()
+    if choice not in ("1", "2", "3", "4"):
+        print("Invalid input, try again.")
+        return summary_report()
+    date_from, date_to = prompt_date_range()
+
+    if choice in ("1", "2"):
+        period = "month" if choice == "1" else "week"
+        for kind, label in (("expense", "Expenses"), ("income", "Income")):
+            rows = period_category_totals(kind, period, date_from=date_from, date_to=date_to)
+            print(f"{label} per {period}:")
+            if not rows:
+                print("  No records.")
+            for period_key, category, total in rows:
+                print(f"  {period_key}  {category:<20} {total:>12}")
+    elif choice == "3":
+        rows = net_revenue_by_period("month", date_from=date_from, date_to=date_to)
+        print(f"  {'Month':<8} {'Income':>12} {'Expenses':>12} {'Net':>12}")
+        for period_key, income, expenses, net in rows:
+            print(f"  {period_key:<8} {income:>12} {expenses:>12} {net:>12}")
+    else:
+        try:
+            n = int(input("How many categories? ") or 5)
+        except ValueError:
+            print("Please enter a valid number.")
+            return
+        for kind, label in (("expense", "expense"), ("income", "income")):
+            print(f"Top {n} {label} categories:")
+            for rank, (category, total) in enumerate(top_categories(kind, n, date_from=date_from, date_to=date_to), start=1):
+                print(f"  {rank}. {category:<20} {total:>12}")
+
+@timed
 def print_report():
-    print("Would you like to:\n1 - Print Expense Report\n2 - Print Income Report\n3 - Print Full Report")
-    print_choice = input("Enter your choice:")
-    if print_choice.strip() == "1":
-        if not expenses_list:
-            print("No expenses to report on.")
-            return
-        print("Here is your expense report:")
-        for index, expense in enumerate(expenses_list, start=1):
-            print(f"Expense #{index}:")
-            for key, value in expense.items():
-                print(f"  {key}: {value}")
-            cvs_expense()
-        
-    elif print_choice.strip() == "2":
-        if not income_list:
-            print("No income to report on.")
-            return
-        print("Here is your income report:")
-        for index, income in enumerate(income_list, start=1):
-            print(f"Income #{index}:")
-            for key, value in income.items():
-                print(f"  {key}: {value}")
-        cvs_income()
-    elif print_choice.strip() == "3":
-        if not expenses_list and not income_list:
-            print("No transactions to report on.")
-            return
-        print("Here is your full report:")
-        if expenses_list:
-            for index, expense in enumerate(expenses_list, start=1):
-                print(f"Expense #{index}:")
-                for key, value in expense.items():
-                    print(f"  {key}: {value}")
-    
-                print("Total expenses:", total_expense())
-
-        if income_list:
-            for index, income in enumerate(income_list, start=1):
-                print(f"Income #{index}:")
-                for key, value in income.items():
-                    print(f"  {key}: {value}")
-                print("Total income:", total_income())
-
-        print("Total:",total_income() - total_expense())
-        cvs_total()
-    else:
-        print("Invalid input, try 1, 2, or 3 again.")
-
+    print("Would you like to:\n1 - Print Expense Report\n2 - Print Income Report\n3 - Print Full Report\n4 - Verify Totals\n5 - Export Parquet Snapshot\n6 - Summary Reports")
+    print_choice = input("Enter your choice:")
+    if print_choice.strip() == "1":
+        if not has_records("expense"):
+            print("No expenses to report on.")
+            return
+        print("Here is your expense report:")
+        for index, expense in enumerate(iter_records("expense"), start=1):
+            print_record("Expense", index, expense)
+        cvs_expense()
+        
+    elif print_choice.strip() == "2":
+        if not has_records("income"):
+            print("No income to report on.")
+            return
+        print("Here is your income report:")
+        for index, income in enumerate(iter_records("income"), start=1):
+            print_record("Income", index, income)
+        cvs_income()
+    elif print_choice.strip() == "3":
+        has_expenses = has_records("expense")
+        has_income = has_records("income")
+        if not has_expenses and not has_income:
+            print("No transactions to report on.")
+            return
+        totalexp, totalinc, totalrev = get_totals()
+        print("Here is your full report:")
+        if has_expenses:
+            for index, expense in enumerate(iter_records("expense"), start=1):
+                print_record("Expense", index, expense)
+            print("Total expenses:", totalexp)
+
+        if has_income:
+            for index, income in enumerate(iter_records("income"), start=1):
+                print_record("Income", index, income)
+            print("Total income:", totalinc)
+
+        print("Total:", totalrev)
+        cvs_total()
+    elif print_choice.strip() == "4":
+        verify_totals()
+    elif print_choice.strip() == "5":
+        parquet_report()
+    elif print_choice.strip() == "6":
+        summary_report()
+    else:
+        print("Invalid input, try 1, 2, 3, 4, 5, or 6 again.")
+
+@timed
 def search_records():
-    if not expenses_list and not income_list:
-        print("No records to search.")
-        return
-    print("Would you like to:\ne - Search expenses\ni - Search income\nv - View all Records")
-    print_choice = input("Enter your choice:")
-    if print_choice.strip().lower() == "e":
-        search_expense()
-    elif print_choice.strip().lower() == "i":
-        search_income()
-    elif print_choice.strip().lower() == "v":
-        view_records()
-    else:
-        print("Invalid input, try again.")
+    if not has_records("expense") and not has_records("income"):
+        print("No records to search.")
+        return
+    print("Would you like to:\ne - Search expenses\ni - Search income\nv - View all Records\nt - Largest records"
+          "\nf - Find by note or category")
+    print_choice = input("Enter your choice:")
+    if print_choice.strip().lower() == "e":
+        search_expense()
+    elif print_choice.strip().lower() == "i":
+        search_income()
+    elif print_choice.strip().lower() == "v":
+        view_records()
+    elif print_choice.strip().lower() == "t":
+        largest_records()
+    elif print_choice.strip().lower() == "f":
+        find_records()
+    else:
+        print("Invalid input, try again.")
 
 def view_records():
-    if not expenses_list and not income_list:
-        print("No records to view.")
-        return
-    print("Would you like to:\ne - View Expenses\ni - View income")
-    print_choice = input("Enter your choice:")
-    if print_choice.strip().lower() == "e":
-        view_expense()
-    elif print_choice.strip().lower() == "i":
-        view_income()
-    else:
-        print("Invalid input, try again.")
-        return view_records()
+    if not has_records("expense") and not has_records("income"):
+        print("No records to view.")
+        return
+    print("Would you like to:\ne - View Expenses\ni - View income")
+    print_choice = input("Enter your choice:")
+    if print_choice.strip().lower() == "e":
+        view_expense()
+    elif print_choice.strip().lower() == "i":
+        view_income()
+    else:
+        print("Invalid input, try again.")
+        return view_records()
 def view_income():
-    if not income_list:
-        print("No income yet.")
-        return
-    for index, income in enumerate(income_list, start=1):
-        print(f"Income #{index}:")
-        for key, value in income.items():
-            print(f"  {key}: {value}")
+    if not has_records("income"):
+        print("No income yet.")
+        return
+    browse_records("income", "Income", order=prompt_sort_order())
 
 def view_expense():
-    if not expenses_list:
-        print("No expenses yet.")
-        return
-    for index, expense in enumerate(expenses_list, start=1):
-        print(f"Expense #{index}:")
-        for key, value in expense.items():
-            print(f"  {key}: {value}")
+    if not has_records("expense"):
+        print("No expenses yet.")
+        return
+    browse_records("expense", "Expense", order=prompt_sort_order())
+
+def prompt_sort_order() -> str:
+    print("Sort by:\n1 - Order of entry\n2 - Date, oldest first\n3 - Date, newest first"
+          "\n4 - Amount, smallest first\n5 - Amount, largest first\n6 - Category")
+    choice = input("Enter your choice (default 1): ").strip() or "1"
+    orders = dict(zip("123456", SORT_ORDERS))
+    if choice not in orders:
+        print("Invalid input, try again.")
+        return prompt_sort_order()
+    return orders[choice]
+
+# Top-N: the largest expenses or income, optionally within a date range
+def largest_records():
+    kind = "income" if input("e - Expenses\ni - Income\n").strip().lower() == "i" else "expense"
+    try:
+        n = int(input("How many records? ") or 10)
+    except ValueError:
+        print("Please enter a valid number.")
+        return
+    date_from, date_to = prompt_date_range()
+    records = query_records(kind, date_from=date_from, date_to=date_to, order="amount_desc", limit=n)
+    if not records:
+        print("No matching records found.")
+    for rank, record in enumerate(records, start=1):
+        print(f"  {rank}. {record['Amount']:>12}  {record['Category']:<20} {record['Date']}")
+
+# Free-text search over notes and category names, newest first, a page at a time
+def find_records():
+    kind, label = ("income", "Income") if input("e - Expenses\ni - Income\n").strip().lower() == "i" else ("expense", "Expense")
+    text = input("Search for: ").strip()
+    fuzzy = input("Allow near matches (typos)? (y/n): ").strip().lower() == "y"
+    before_id = None
+    number = 0
+    while True:
+        page = text_search(kind, text, fuzzy=fuzzy, before_id=before_id)
+        if not page:
+            print("No more records." if number else "No matching records found.")
+            return
+        for record in page:
+            number += 1
+            print_record(label, number, record)
+        if len(page) < PAGE_SIZE or input("n - Next page, q - Stop browsing: ").strip().lower() != "n":
+            return
+        before_id = page[-1]["ID"]
+
+# Shared prompt flow for edit_inc/edit_exp
+def edit_record(kind: str, label: str):
+    record = browse_records(kind, label, select=True)
+    if record is None:
+        return
+
+    print("What would you like to edit?\n1 - Amount\n2 - Category\n3 - Date\n4 - Note")
+    edit_choice = input("Enter your choice:").strip()
+    try:
+        # Editing Amount
+        if edit_choice == "1":
+            updated = update_record(kind, record["ID"], amount=int(input("Enter the new amount: ")))
+        # Editing Category
+        elif edit_choice == "2":
+            print("Choose a new category:")
+            new_category = select_categories() if kind == "expense" else select_income_cat()
+            updated = update_record(kind, record["ID"], category=new_category)
+        # Editing Date
+        elif edit_choice == "3":
+            updated = update_record(kind, record["ID"], date=get_valid_date())
+        # Editing Note
+        elif edit_choice == "4":
+            updated = update_record(kind, record["ID"], note=input("Enter the new note (blank to clear): "))
+        else:
+            print("Invalid choice.")
+            return
+    except ValueError as e:
+        print(f"Please enter a valid value: {e}")
+        return
+
+    if updated:
+        print(f"{label} updated successfully.")
+    else:
+        print(f"{label} record no longer exists.")
 
 def edit_inc():
-    if not income_list:
-        print("No income records yet.")
-        return
-
- # Print income list
-    for index, income in enumerate(income_list, start=1):
-        print(f"Income #{index}:")
-        for key, value in income.items():
-            print(f" {key}: {value}")
-
- # Select record to edit
-    try:
-        edit_income = int(input("Enter the income record number you want to edit: ")) - 1
-        if 0 <= edit_income < len(income_list):
-            print("What would you like to edit?\n1 - Amount\n2 - Category\n3 - Date")
-            edit_choice = input("Enter your choice:").strip()
-            conn = sqlite3.connect('expense_tracker.db')
-            c = conn.cursor()
-
-  # Editing Amount
-            if edit_choice == "1":
-                new_amount = int(input("Enter the new amount: "))
-                income_list[edit_income]["Amount"] = new_amount
-                c.execute('UPDATE income SET amount = ? WHERE id = ?', 
-                (new_amount, income_list[edit_income]['ID']))
-
-  # Editing Category
-            elif edit_choice == "2":
-                print("Choose a new category:")
-                for i, cat in enumerate(income_cat_list, start=1):
-                    print(f"{i} - {cat}")
-                    new_category_index = int(input("Select category number: ")) - 1
-                if 0 <= new_category_index < len(income_cat_list):
-                    new_category = income_cat_list[new_category_index]
-                    income_list[edit_income]["Category"] = new_category
-                    c.execute('UPDATE income SET category_id = (SELECT id FROM income_categories WHERE category_name = ?) WHERE id = ?', 
-                    (new_category, income_list[edit_income]['ID']))
-                else:
-                    print("Invalid category number.")
-                    return
-  # Editing Date
-            elif edit_choice == "3":
-                new_date = get_valid_date()
-                income_list[edit_income]["Date"] = new_date
-                c.execute('UPDATE income SET date = ? WHERE id = ?', 
-                    (new_date, income_list[edit_income]['ID']))
-            else:
-                print("Invalid choice.")
-                return
-
-            conn.commit()
-            conn.close()
-            print("Income updated successfully.")
-        else:
-            print("Invalid income record number.")
-    except ValueError:
-            print("Please enter a valid number.")
-            print("Total income:", total_income())
+    if not has_records("income"):
+        print("No income records yet.")
+        return
+    edit_record("income", "Income")
 
 def edit_exp():
-    if not expenses_list:
-        print("No expenses yet.")
-        return
-
- # Print expenses list
-    for index, expense in enumerate(expenses_list, start=1):
-        print(f"Expense #{index}:")
-        for key, value in expense.items():
-            print(f" {key}: {value}")
-
- # Select record to edit
-    try:
-        edit_expense = int(input("Enter the expense record number you want to edit: ")) - 1
-        if 0 <= edit_expense < len(expenses_list):
-            print("What would you like to edit?\n1 - Amount\n2 - Category\n3 - Date")
-            edit_choice = input("Enter your choice:").strip()
-            conn = sqlite3.connect('expense_tracker.db')
-            c = conn.cursor()
-
-  # Editing Amount
-            if edit_choice == "1":
-                new_amount = int(input("Enter the new amount: "))
-                expenses_list[edit_expense]["Amount"] = new_amount
-                c.execute('UPDATE expenses SET amount = ? WHERE id = ?', 
-                    (new_amount, expenses_list[edit_expense]['ID']))
-
-  # Editing Category
-            elif edit_choice == "2":
-                print("Choose a new category:")
-                c.execute('SELECT category_name FROM expense_categories')
-                categories = c.fetchall()
-            for i, (cat,) in enumerate(categories, start=1):
-                print(f"{i} - {cat}")
-                new_category_index = int(input("Select category number: ")) - 1
-                if 0 <= new_category_index < len(categories):
-                    new_category = categories[new_category_index][0]
-                    expenses_list[edit_expense]["Category"] = new_category
-                    c.execute('UPDATE expenses SET category_id = (SELECT id FROM expense_categories WHERE category_name = ?) WHERE id = ?', 
-                        (new_category, expenses_list[edit_expense]['ID']))
-                else:
-                    print("Invalid category number.")
-                    return
-            # Editing Date
-        elif edit_choice == "3":
-                new_date = get_valid_date()
-                expenses_list[edit_expense]["Date"] = new_date
-                c.execute('UPDATE expenses SET date = ? WHERE id = ?', 
-                        (new_date, expenses_list[edit_expense]['ID']))
-        else:
-            print("Invalid choice.")
-            return
-
-        conn.commit()
-        conn.close()
-        print("Expense updated successfully.")
-    except ValueError:
-            print("Please enter a valid number.")
-
-            print("Total expenses:", total_expense())
+    if not has_records("expense"):
+        print("No expenses yet.")
+        return
+    edit_record("expense", "Expense")
+
+# Shared prompt flow for delete_income/delete_expense
+def delete_record(kind: str, label: str):
+    record = browse_records(kind, label, select=True)
+    if record is None:
+        return
+    try:
+        if remove_record(kind, record["ID"]):
+            print(f"{label} record #{record['ID']} deleted successfully.")
+        else:
+            print("Invalid record number.")
+    except sqlite3.Error as e:
+        print(f"An error occurred: {e}")
 
 def delete_income():
-    if not income_list:
-        print("No income records yet.")
-        return
-    # Print income list
-    for index, income in enumerate(income_list, start=1):
-        print(f"Income #{index}:")
-        for key, value in income.items():
-            print(f" {key}: {value}")
-            try:
-                delete_inc = int(input("Enter the income record number you want to delete: ")) - 1
-                if 0 <= delete_inc < len(income_list):
-                    deleted_income = income_list.pop(delete_inc)
-
-                    conn = sqlite3.connect('expense_tracker.db')
-                    c = conn.cursor()
-                    c.execute('DELETE FROM income WHERE id = ?', (deleted_income['ID'],))
-                    conn.commit()
-                    conn.close()
-                    print(f"Income record #{delete_inc + 1} deleted successfully.")
-                else:
-                    print("Invalid record number.")
-            except ValueError:
-                print("Please enter a valid number.")
-            except sqlite3.Error as e:
-                print(f"An error occurred: {e}")
+    if not has_records("income"):
+        print("No income records yet.")
+        return
+    delete_record("income", "Income")
 
 def delete_expense():
-    if not expenses_list:
-        print("No expenses yet.")
-        return
-
- # Print expenses list
-    for index, expense in enumerate(expenses_list, start=1):
-        print(f"Expense #{index}:")
-        for key, value in expense.items():
-            print(f" {key}: {value}")
-
-        try:
-            delete_exp = int(input("Enter the expense record number you want to delete: ")) - 1
-            if 0 <= delete_exp < len(expenses_list):
-                deleted_expense = expenses_list.pop(delete_exp)
-                conn = sqlite3.connect('expense_tracker.db')
-                c = conn.cursor()
-                c.execute('DELETE FROM expenses WHERE id = ?', (deleted_expense['ID'],))
-                conn.commit()
-                conn.close()
-                print(f"Expense record #{delete_exp + 1} deleted successfully.")
-            else:
-                print("Invalid record number.")
-        except ValueError:
-            print("Please enter a valid number.")
-        except sqlite3.Error as e:
-            print(f"An error occurred: {e}")
-def search_expense():    
-    if not expenses_list:
-        print("No expenses yet.")
-        return
-    
-    print("Search by:")
-    print("1 - Amount")
-    print("2 - Category")
-    print("3 - Date")
-    
-    search_choice = input("Enter your choice: ")
-    
-    if search_choice == "1":
-        search_amount = int(input("Enter the amount to search for: "))
-        results = [expense for expense in expenses_list if expense['Amount'] == search_amount]
-    elif search_choice == "2":
-        search_category = input("Enter the category to search for: ").lower()
-        results = [expense for expense in expenses_list if expense['Category'].lower() == search_category]
-    elif search_choice == "3":
-        search_date = input("Enter the date to search for (YYYY-MM-DD): ")
-        results = [expense for expense in expenses_list if expense['Date'] == search_date]
-    else:
-        print("Invalid choice.")
-        return
-    
-    if results:
-        for index, expense in enumerate(results, start=1):
-            print(f"Expense #{index}:")
-            for key, value in expense.items():
-                print(f"  {key}: {value}")
-            print()  # Separate results with a newline
-    else:
-        print("No matching records found.")
+    if not has_records("expense"):
+        print("No expenses yet.")
+        return
+    delete_record("expense", "Expense")
+
+# Ask which search to run and return the matching filters for query_records()
+def prompt_search_filters() -> Optional[dict]:
+    print("Search by:")
+    print("1 - Amount")
+    print("2 - Category")
+    print("3 - Date")
+    print("4 - Date range")
+    print("5 - Amount range")
+    print("6 - Year, quarter or month")
+
+    search_choice = input("Enter your choice: ")
+
+    try:
+        if search_choice == "1":
+            return {"amount": int(input("Enter the amount to search for: "))}
+        elif search_choice == "2":
+            return {"category": input("Enter the category to search for: ").strip().lower()}
+        elif search_choice == "3":
+            search_date = parse_date(input("Enter the date to search for (YYYY-MM-DD): "))
+            return {"date_from": search_date, "date_to": search_date}
+        elif search_choice == "4":
+            return {
+                "date_from": parse_date(input("From date (YYYY-MM-DD): ")),
+                "date_to": parse_date(input("To date (YYYY-MM-DD): ")),
+            }
+        elif search_choice == "5":
+            return {
+                "amount_min": int(input("Minimum amount: ")),
+                "amount_max": int(input("Maximum amount: ")),
+            }
+        elif search_choice == "6":
+            date_from, date_to = period_bounds(input("Enter the period (2024, 2024-Q2 or 2024-06): "))
+            return {"date_from": date_from, "date_to": date_to}
+    except ValueError:
+        print("Invalid value, please try again.")
+        return None
+    print("Invalid choice.")
+    return None
+
+def search_expense():    
+    if not has_records("expense"):
+        print("No expenses yet.")
+        return
+
+    filters = prompt_search_filters()
+    if filters is not None:
+        browse_records("expense", "Expense", order=prompt_sort_order(), filters=filters)
+
 def search_income():
-    if not income_list:
-        print("No income yet.")
-        return
-    
-    print("Search by:")
-    print("1 - Amount")
-    print("2 - Category")
-    print("3 - Date")
-    
-    search_choice = input("Enter your choice: ")
-    
-    if search_choice == "1":
-        search_amount = int(input("Enter the amount to search for: "))
-        results = [income for income in income_list if income['Amount'] == search_amount]
-    elif search_choice == "2":
-        search_category = input("Enter the category to search for: ").lower()
-        results = [income for income in income_list if income['Category'].lower() == search_category]
-    elif search_choice == "3":
-        search_date = input("Enter the date to search for (YYYY-MM-DD): ")
-        results = [income for income in income_list if income['Date'] == search_date]
-    else:
-        print("Invalid choice.")
-        return
-    
-    if results:
-        for index, income in enumerate(results, start=1):
-            print(f"Income #{index}:")
-            for key, value in income.items():
-                print(f"  {key}: {value}")
-            print()  # Separate results with a newline
-    else:
-        print("No matching records found.")
+    if not has_records("income"):
+        print("No income yet.")
+        return
 
+    filters = prompt_search_filters()
+    if filters is not None:
+        browse_records("income", "Income", order=prompt_sort_order(), filters=filters)
 
-def delete_records():
-    if not income_list and not expenses_list:
-        print("No records to delete.")
-        return
-
-    delete_rec = input("e - Delete expense records \ni - Delete income records\n").strip().lower()
-    if delete_rec == "e":
-        delete_expense()
-    elif delete_rec == "i":
-        delete_income()
-    else:
-        print("Invalid input, try again.")
-        return delete_records()
 
+@timed
+def delete_records():
+    if not has_records("income") and not has_records("expense"):
+        print("No records to delete.")
+        return
+
+    delete_rec = input("e - Delete expense records \ni - Delete income records\nx - Remove duplicate records\n").strip().lower()
+    if delete_rec == "e":
+        delete_expense()
+    elif delete_rec == "i":
+        delete_income()
+    elif delete_rec == "x":
+        for kind in RECORD_TABLES:
+            print(f"Removed {dedupe_records(kind, scoped_user())} duplicate {kind} records.")
+    else:
+        print("Invalid input, try again.")
+        return delete_records()
+
+@timed
 def edit_records():
-    if not income_list and not expenses_list:
-        print("No records to edit.")
-        return
-
-    edit_rec = input("e - Edit expense records \ni - Edit income records\n").strip().lower()
-    if edit_rec == "e":
-        edit_exp()
-    elif edit_rec == "i":
-        edit_inc()
-    else:
-        print("Invalid input, try again.")
-        return edit_records()
+    if not has_records("income") and not has_records("expense"):
+        print("No records to edit.")
+        return
+
+    edit_rec = input("e - Edit expense records \ni - Edit income records\n").strip().lower()
+    if edit_rec == "e":
+        edit_exp()
+    elif edit_rec == "i":
+        edit_inc()
+    else:
+        print("Invalid input, try again.")
+        return edit_records()
 
 def choices():
-    choice = input("Enter your choice:")
-    if choice == "1":
-        create_records()
-    elif choice == "2":
-        category_manager()
-    elif choice == "3":
-        search_records()
-    elif choice == "4":
-        edit_records()
-    elif choice.lower().strip() =="p":
-        print_report()
-    elif choice.lower().strip() == "d":
-        delete_records()
-    elif choice.lower().strip() == "e":
-        print("Exiting the program...")
-        print("See ya.")
-        exit()
-    else:
-        print("Invalid input, try again.")
+    choice = input("Enter your choice:")
+    if READ_ONLY and choice.lower().strip() in ("1", "2", "4", "5", "r", "d"):
+        print("This session is read-only. Restart without --read-only to make changes.")
+    elif choice == "1":
+        create_records()
+    elif choice == "2":
+        category_manager()
+    elif choice == "3":
+        search_records()
+    elif choice == "4":
+        edit_records()
+    elif choice == "5":
+        import_menu()
+    elif choice.lower().strip() =="p":
+        print_report()
+    elif choice.lower().strip() == "r":
+        recurring_menu()
+    elif choice.lower().strip() == "d":
+        delete_records()
+    elif choice.lower().strip() == "e":
+        print("Exiting the program...")
+        print("See ya.")
+        exit()
+    else:
+        print("Invalid input, try again.")
+
+# Log in (or register first) before the main menu; returns the user id
+def login_menu() -> int:
+    while True:
+        if not has_users() and READ_ONLY:
+            return 1  # Single-user database from before accounts existed
+        elif not has_users():
+            print("No accounts yet. Register one to get started.")
+            choice = "2"
+        else:
+            print("1 - Log In\n2 - Register\ne - Exit Program")
+            choice = input("Enter your choice:").strip().lower()
+
+        if choice == "1":
+            username = input("Username: ").strip()
+            user_id = authenticate_user(username, getpass.getpass("Password: "))
+            if user_id is not None:
+                return user_id
+        elif choice == "2" and READ_ONLY:
+            print("This session is read-only. Restart without --read-only to register.")
+        elif choice == "2":
+            username = input("Choose a username: ").strip()
+            password = getpass.getpass("Choose a password: ")
+            if not username or not password:
+                print("Username and password can't be empty.")
+            elif password != getpass.getpass("Repeat the password: "):
+                print("Passwords don't match.")
+            else:
+                register_user(username, password)
+        elif choice == "e":
+            print("Exiting the program...")
+            print("See ya.")
+            exit()
+        else:
+            print("Invalid input, try again.")
+
+# Interactive console session
+def run_interactive():
+    user_id = login_menu()
+    set_current_user(user_id)
+    if not READ_ONLY:
+        written = materialize_rules(user_id=user_id)  # Catch up on recurring records since the last session
+        if written:
+            print(f"{written} recurring records written.")
+    # Records are fetched page by page and categories on first use, so nothing is loaded up front
+    while True: 
+        welcome()
+        choices()
+        while True:
+            mainmenu = input("Return to main menu? (y/n) \n")
+            if mainmenu.lower().strip() == "n":
+                print("Exiting the program...")
+                print("See ya.")
+                exit()
+            elif mainmenu.lower().strip() == "y":
+                break
+            else:
+                print("Invalid input, try again.")
+
+# HTTP JSON API. ThreadingHTTPServer runs each connection on its own thread; reads borrow a
+# read-only connection from a pool while writes take turns on the main connection.
+API_READERS = 8             # Read-only connections in the pool
+API_METRICS_WINDOW = 10000  # Latest request timings kept per route for percentiles
+
+_read_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+_metrics_lock = threading.Lock()
+_api_metrics: Dict[str, dict] = {}
+
+def open_read_pool(size: int = API_READERS):
+    for _ in range(size):
+        _read_pool.put(connect_readonly())
+
+def close_read_pool():
+    while True:
+        try:
+            _read_pool.get_nowait().close()
+        except queue.Empty:
+            return
+
+# Run the block on a pooled read-only connection; connect_db() returns it until the block ends
+@contextmanager
+def read_connection():
+    conn = _read_pool.get()
+    token = _read_conn.set(conn)
+    try:
+        yield conn
+    finally:
+        _read_conn.reset(token)
+        _read_pool.put(conn)
+
+def record_request(route: str, status: int, seconds: float):
+    with _metrics_lock:
+        stats = _api_metrics.get(route)
+        if stats is None:
+            stats = _api_metrics[route] = {"count": 0, "errors": 0, "total_s": 0.0,
+                                           "latencies": deque(maxlen=API_METRICS_WINDOW)}
+        stats["count"] += 1
+        stats["errors"] += status >= 400
+        stats["total_s"] += seconds
+        stats["latencies"].append(seconds)
+
+# Request counts and latency percentiles (milliseconds) per route
+def api_metrics() -> dict:
+    with _metrics_lock:
+        snapshot = {route: (stats["count"], stats["errors"], stats["total_s"], sorted(stats["latencies"]))
+                    for route, stats in _api_metrics.items()}
+    report = {}
+    for route, (count, errors, total_s, latencies) in snapshot.items():
+        def pct(p):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3)
+        report[route] = {"count": count, "errors": errors, "mean_ms": round(total_s / count * 1000, 3),
+                         "p50_ms": pct(0.50), "p95_ms": pct(0.95), "p99_ms": pct(0.99),
+                         "max_ms": round(latencies[-1] * 1000, 3)}
+    return report
+
+def record_json(record: dict) -> dict:
+    return {"id": record["ID"], "amount": record["Amount"], "category": record["Category"], "date": record["Date"],
+            "note": record.get("Note")}
+
+def optional_int(value: Optional[str]) -> Optional[int]:
+    return int(value) if value not in (None, "") else None
+
+# Amounts in a JSON body must be integers: int() would store 12.9 as 12 and true as 1
+def body_amount(value) -> int:
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError("The amount must be a whole number.")
+    return value
+
+def optional_date(value: Optional[str]) -> Optional[str]:
+    return parse_date(value) if value else None
+
+def api_login(params: dict, query: dict, body: dict):
+    user_id = verify_credentials(str(body.get("username", "")), str(body.get("password", "")))
+    if user_id is None:
+        return 401, {"error": "Authentication failed."}
+    return 200, {"token": create_session(user_id)}
+
+def api_logout(params: dict, query: dict, body: dict):
+    end_session(params["token"])
+    return 204, None
+
+# One page of records, optionally filtered and sorted (?sort=amount_desc&limit=20 is a top 20).
+# The next page starts at ?after=<next> (plus &after_key=<next_key> when sorted).
+def api_list_records(params: dict, query: dict, body: dict):
+    kind = params["kind"]
+    filters = {
+        "amount": optional_int(query.get("amount")),
+        "amount_min": optional_int(query.get("min")),
+        "amount_max": optional_int(query.get("max")),
+        "category": query["category"].strip().lower() if query.get("category") else None,
+        "date_from": optional_date(query.get("date") or query.get("from")),
+        "date_to": optional_date(query.get("date") or query.get("to")),
+    }
+    if query.get("during"):
+        filters["date_from"], filters["date_to"] = period_bounds(query["during"])
+    order = query.get("sort", "id")
+    if order not in SORT_ORDERS:
+        raise ValueError(f"Unknown sort '{order}'.")
+    after = None
+    if query.get("after"):
+        after_id = int(query["after"])
+        if SORT_ORDERS[order][0] is None:
+            after = (after_id,)
+        else:
+            after_key = query["after_key"]
+            after = (int(after_key) if SORT_ORDERS[order][0] == "amount" else after_key, after_id)
+    limit = max(1, min(optional_int(query.get("limit")) or PAGE_SIZE, STREAM_PAGE_SIZE))
+    if query.get("q"):
+        # Text search over notes and categories, newest first; ?after=<next> continues it
+        page = text_search(kind, query["q"], fuzzy=query.get("fuzzy") in ("1", "true"), limit=limit,
+                           before_id=optional_int(query.get("after")))
+        return 200, {"records": [record_json(r) for r in page],
+                     "next": page[-1]["ID"] if len(page) == limit else None}
+    page = query_records(kind, **filters, order=order, after=after, limit=limit)
+    response = {"records": [record_json(r) for r in page], "next": None}
+    if len(page) == limit:
+        position = sort_position(order, page[-1])
+        response["next"] = position[-1]
+        if len(position) == 2:
+            response["next_key"] = position[0]
+    return 200, response
+
+# Record writes go through the write queue, so concurrent requests share a commit. By default the
+# response waits for that commit ("durable": true); with ?wait=false it returns 202 as soon as the
+# write is journaled, before it is committed.
+def queued_response(query: dict, future: Future):
+    if query.get("wait") == "false":
+        return 202, {"queued": True, "durable": False}
+    return None, future.result()
+
+def api_create_record(params: dict, query: dict, body: dict):
+    kind = params["kind"]
+    category = str(body.get("category", "")).strip().lower()
+    if body.get("create_category"):
+        with _write_lock:
+            add_category(kind, category)
+    status, record_id = queued_response(query, queue_insert(
+        kind, body_amount(body["amount"]), category, str(body["date"]),
+        external_ref=str(body["ref"]) if body.get("ref") else None,
+        note=(str(body["note"]).strip() or None) if body.get("note") else None))
+    if status:
+        return status, record_id
+    if record_id is None:
+        return 200, {"id": None, "duplicate": True, "durable": True}  # Already stored, so retrying a POST is safe
+    return 201, {"id": record_id, "durable": True}
+
+def api_update_record(params: dict, query: dict, body: dict):
+    category = body.get("category")
+    status, updated = queued_response(query, queue_update(
+        params["kind"], int(params["id"]),
+        amount=body_amount(body["amount"]) if body.get("amount") is not None else None,
+        category=str(category).strip().lower() if category else None,
+        date=str(body["date"]) if body.get("date") else None,
+        note=str(body["note"]) if body.get("note") is not None else None))
+    if status:
+        return status, updated
+    return (200, {"id": int(params["id"]), "durable": True}) if updated else (404, {"error": "No such record."})
+
+def api_delete_record(params: dict, query: dict, body: dict):
+    status, removed = queued_response(query, queue_delete(params["kind"], int(params["id"])))
+    if status:
+        return status, removed
+    return (204, None) if removed else (404, {"error": "No such record."})
+
+def api_create_category(params: dict, query: dict, body: dict):
+    name = str(body.get("name", "")).strip().lower()
+    if not name:
+        raise ValueError("Category name can't be empty.")
+    return 201, {"id": add_category(params["kind"], name)}
+
+def api_totals(params: dict, query: dict, body: dict):
+    expenses, income, total = get_totals()
+    return 200, {"expenses": expenses, "income": income, "total": total}
+
+def api_report(params: dict, query: dict, body: dict):
+    report = params["report"]
+    kind = query.get("kind", "expense")
+    if kind not in RECORD_TABLES:
+        raise ValueError(f"Unknown kind '{kind}'.")
+    date_from = optional_date(query.get("from"))
+    date_to = optional_date(query.get("to"))
+    if query.get("during"):
+        date_from, date_to = period_bounds(query["during"])
+    if report in ("monthly", "weekly"):
+        rows = period_category_totals(kind, "month" if report == "monthly" else "week",
+                                      date_from=date_from, date_to=date_to)
+        return 200, {"rows": [{"period": p, "category": c, "total": t} for p, c, t in rows]}
+    if report == "net":
+        period = query.get("period", "month")
+        if period not in PERIOD_FORMATS:
+            raise ValueError(f"Unknown period '{period}'.")
+        rows = net_revenue_by_period(period, date_from=date_from, date_to=date_to)
+        return 200, {"rows": [{"period": p, "income": i, "expenses": e, "net": n} for p, i, e, n in rows]}
+    rows = top_categories(kind, max(1, optional_int(query.get("limit")) or 5), date_from=date_from, date_to=date_to)
+    return 200, {"rows": [{"category": c, "total": t} for c, t in rows]}
+
+def api_get_metrics(params: dict, query: dict, body: dict):
+    return 200, api_metrics()
+
+# Placeholders allowed in route paths and what they match
+API_PATH_PARAMS = {
+    "kind": "|".join(RECORD_TABLES),
+    "id": r"\d+",
+    "report": "monthly|weekly|net|top",
+}
+
+# (method, path, handler, access). Access is "read" (pooled connection), "write"
+# (main connection, one at a time) or "none" (record writes take the lock in the write queue).
+API_ROUTES = [
+    ("POST", "/login", api_login, "read"),
+    ("POST", "/logout", api_logout, "none"),
+    ("GET", "/records/{kind}", api_list_records, "read"),
+    ("POST", "/records/{kind}", api_create_record, "none"),
+    ("PATCH", "/records/{kind}/{id}", api_update_record, "none"),
+    ("DELETE", "/records/{kind}/{id}", api_delete_record, "none"),
+    ("POST", "/categories/{kind}", api_create_category, "write"),
+    ("GET", "/totals", api_totals, "read"),
+    ("GET", "/reports/{report}", api_report, "read"),
+    ("GET", "/metrics", api_get_metrics, "none"),
+]
+
+def route_pattern(path: str) -> "re.Pattern":
+    return re.compile(re.sub(r"\{(\w+)\}", lambda m: f"(?P<{m[1]}>{API_PATH_PARAMS[m[1]]})", path) + "/?")
+
+API_ROUTES = [(method, route_pattern(path), f"{method} {path}", handler, access)
+              for method, path, handler, access in API_ROUTES]
+API_PUBLIC = (api_login, api_get_metrics)  # Everything else needs "Authorization: Bearer <token>"
+
+class ApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so clients reuse their connection
+    disable_nagle_algorithm = True  # Headers and body go out as separate writes
+
+    def log_message(self, format, *args):
+        pass  # Timings go to /metrics instead of a line per request
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PATCH(self):
+        self.dispatch("PATCH")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def dispatch(self, method: str):
+        start = time.perf_counter()
+        route = "unmatched"
+        try:
+            url = urllib.parse.urlsplit(self.path)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length)) if length else {}
+            if not isinstance(body, dict):
+                raise ValueError("The request body must be a JSON object.")
+            status, payload = 404, {"error": "Not found."}
+            for route_method, pattern, name, handler, access in API_ROUTES:
+                match = pattern.fullmatch(url.path)
+                if match and route_method == method:
+                    route = name
+                    status, payload = self.call(handler, access, match.groupdict(), query, body)
+                    break
+        except (ValueError, KeyError, TypeError) as e:
+            status, payload = 400, {"error": str(e) or "Invalid request."}
+        except LoginLockedOut as e:
+            status, payload = 429, {"error": str(e)}
+        except PermissionError as e:
+            status, payload = 403, {"error": str(e)}
+        except sqlite3.Error as e:
+            status, payload = 500, {"error": f"Database error: {e}"}
+        self.respond(status, payload)
+        record_request(route, status, time.perf_counter() - start)
+
+    def call(self, handler, access: str, params: dict, query: dict, body: dict):
+        if handler not in API_PUBLIC:
+            token = self.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+            user_id = session_user(token)
+            if user_id is None:
+                return 401, {"error": "Log in first."}
+            params["token"] = token
+            with user_scope(user_id):
+                return self.call_with_access(handler, access, params, query, body)
+        return self.call_with_access(handler, access, params, query, body)
+
+    def call_with_access(self, handler, access: str, params: dict, query: dict, body: dict):
+        if access == "read":
+            with read_connection():
+                return handler(params, query, body)
+        if access == "write":
+            with _write_lock:
+                return handler(params, query, body)
+        return handler(params, query, body)
+
+    def respond(self, status: int, payload):
+        data = b"" if payload is None else json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        if data:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+# Serve the API until interrupted
+def serve_api(host: str = "127.0.0.1", port: int = 8000, readers: int = API_READERS):
+    connect_db()  # The writer opens the database (and its WAL files) before the read-only pool
+    open_read_pool(readers)
+    server = ThreadingHTTPServer((host, port), ApiHandler, bind_and_activate=False)
+    server.daemon_threads = True
+    server.request_queue_size = 128  # Room for bursts of new connections
+    server.server_bind()
+    server.server_activate()
+    print(f"Serving the tracker API on http://{host}:{server.server_address[1]}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        close_read_pool()
+
+# Non-interactive commands. Each returns a process exit status: 0 on success, 1 on failure.
+
+def write_rows(header: List[str], rows, as_json: bool = False):
+    if as_json:
+        for row in rows:
+            print(json.dumps(dict(zip(header, row))))
+        return
+    writer = csv.writer(sys.stdout)
+    writer.writerow(header)
+    writer.writerows(rows)
+
+# Password for command-line use: $TRACKER_PASSWORD when set (for cron), otherwise a prompt
+def cli_password(prompt: str = "Password: ") -> str:
+    return os.environ.get("TRACKER_PASSWORD") or getpass.getpass(prompt)
+
+def cmd_register(args) -> int:
+    password = cli_password()
+    if not password:
+        print("Password can't be empty.", file=sys.stderr)
+        return 1
+    user_id = create_user(args.username, password)
+    if user_id is None:
+        print("Username already exists.", file=sys.stderr)
+        return 1
+    print(user_id)
+    return 0
+
+def cmd_role(args) -> int:
+    require_admin("change roles")
+    with transaction() as conn:
+        changed = conn.execute('UPDATE users SET role = ? WHERE username = ?', (args.role, args.username)).rowcount
+    if not changed:
+        print(f"No user named {args.username}.", file=sys.stderr)
+        return 1
+    print(f"{args.username} is now {'an admin' if args.role == 'admin' else 'a regular user'}.")
+    return 0
+
+def cmd_add(args) -> int:
+    try:
+        if args.create_category:
+            add_category(args.kind, args.category.strip().lower())
+        record_id = insert_record(args.kind, args.amount, args.category.strip().lower(), args.date,
+                                  external_ref=args.ref, note=args.note)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if record_id is None:
+        print("Duplicate of an existing record, not saved.", file=sys.stderr)
+    else:
+        print(record_id)
+    return 0
+
+def cmd_import(args) -> int:
+    try:
+        import_records(args.path, args.kind)
+    except OSError as e:
+        print(f"Could not read '{args.path}': {e}", file=sys.stderr)
+        return 1
+    except json.JSONDecodeError as e:
+        print(f"An error occurred during import: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+def cmd_search(args) -> int:
+    try:
+        date_from = parse_date(args.date or args.date_from) if (args.date or args.date_from) else None
+        date_to = parse_date(args.date or args.date_to) if (args.date or args.date_to) else None
+    except ValueError:
+        print("Invalid date format. Use YYYY-MM-DD or YYYY/MM/DD.", file=sys.stderr)
+        return 1
+    if args.during:
+        try:
+            date_from, date_to = period_bounds(args.during)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 1
+    results = query_records(args.kind, amount=args.amount,
+                            category=args.category.strip().lower() if args.category else None,
+                            date_from=date_from, date_to=date_to,
+                            amount_min=args.min, amount_max=args.max, order=args.sort, limit=args.limit)
+    write_rows(["ID", "Amount", "Category", "Date"],
+               ([r["ID"], r["Amount"], r["Category"], r["Date"]] for r in results), args.json)
+    return 0 if results else NO_MATCH
+
+def cmd_find(args) -> int:
+    results = text_search(args.kind, args.text, fuzzy=args.fuzzy, limit=args.limit)
+    write_rows(["ID", "Amount", "Category", "Date", "Note"],
+               ([r["ID"], r["Amount"], r["Category"], r["Date"], r["Note"]] for r in results), args.json)
+    return 0 if results else NO_MATCH
+
+def cmd_report(args) -> int:
+    try:
+        date_from = parse_date(args.date_from) if args.date_from else None
+        date_to = parse_date(args.date_to) if args.date_to else None
+    except ValueError:
+        print("Invalid date format. Use YYYY-MM-DD or YYYY/MM/DD.", file=sys.stderr)
+        return 1
+    if args.during:
+        try:
+            date_from, date_to = period_bounds(args.during)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            return 1
+    if args.report == "totals":
+        write_rows(["Total expenses", "Total income", "Total"], [get_totals()], args.json)
+    elif args.report in ("monthly", "weekly"):
+        period = "month" if args.report == "monthly" else "week"
+        write_rows(["Period", "Category", "Total"],
+                   period_category_totals(args.kind, period, date_from=date_from, date_to=date_to), args.json)
+    elif args.report == "net":
+        write_rows(["Period", "Income", "Expenses", "Net"],
+                   net_revenue_by_period(args.period, date_from=date_from, date_to=date_to), args.json)
+    elif args.report == "top":
+        write_rows(["Category", "Total"],
+                   top_categories(args.kind, args.limit, date_from=date_from, date_to=date_to), args.json)
+    elif args.report == "check":
+        mismatched = check_totals(repair=args.repair)
+        if mismatched:
+            print(f"Totals out of date for user(s): {', '.join(map(str, mismatched))}", file=sys.stderr)
+            return 0 if args.repair else 1
+    return 0
+
+def cmd_export(args) -> int:
+    try:
+        if args.target == "parquet":
+            for kind in RECORD_TABLES:
+                written = export_parquet(kind, args.path, incremental=not args.full)
+                print(f"{written} {kind} records exported to {args.path}.")
+        elif args.target == "totals":
+            export_totals_csv(args.path)
+        elif args.target == "reports":
+            date_from = parse_date(args.date_from) if args.date_from else None
+            date_to = parse_date(args.date_to) if args.date_to else None
+            files, rows = run_batch_reports(args.path, args.workers, date_from, date_to, all_users=args.all_users)
+            print(f"{files} files ({rows} records) written to {args.path}"
+                  + (" for all users." if args.all_users else "."))
+        else:
+            date_from = parse_date(args.date_from) if args.date_from else None
+            date_to = parse_date(args.date_to) if args.date_to else None
+            written = export_csv(args.target, args.path, date_from, date_to,
+                                 compress=args.gzip or args.path.endswith(".gz"))
+            print(f"{written} records written to {args.path}.")
+    except ValueError:
+        print("Invalid date format. Use YYYY-MM-DD or YYYY/MM/DD.", file=sys.stderr)
+        return 1
+    except (RuntimeError, OSError) as e:
+        print(f"Export failed: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+def cmd_rules_add(args) -> int:
+    try:
+        if args.create_category:
+            add_category(args.kind, args.category.strip().lower())
+        rule_id = add_rule(args.kind, args.amount, args.category.strip().lower(), args.cadence, args.start,
+                           args.end, args.note)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    print(rule_id)
+    return 0
+
+def cmd_rules_list(args) -> int:
+    write_rows(["ID", "Kind", "Amount", "Category", "Cadence", "Start", "End", "Written through", "Note"],
+               list_rules(), args.json)
+    return 0
+
+def cmd_rules_delete(args) -> int:
+    status = 0
+    for rule_id in args.ids:
+        if remove_rule(rule_id):
+            print(f"Deleted rule {rule_id}.")
+        else:
+            print(f"No rule with ID {rule_id}.", file=sys.stderr)
+            status = 1
+    return status
+
+def cmd_rules_run(args) -> int:
+    if args.all_users:
+        require_admin("run every user's rules")
+    try:
+        written = materialize_rules(args.through, None if args.all_users else scoped_user())
+    except ValueError:
+        print("Invalid date format. Use YYYY-MM-DD or YYYY/MM/DD.", file=sys.stderr)
+        return 1
+    print(f"{written} recurring records written.")
+    return 0
+
+def cmd_dedupe(args) -> int:
+    if args.all_users:
+        require_admin("remove every user's duplicates")
+    for kind in ([args.kind] if args.kind else RECORD_TABLES):
+        print(f"Removed {dedupe_records(kind, None if args.all_users else scoped_user())} duplicate {kind} records.")
+    return 0
+
+def cmd_delete(args) -> int:
+    status = 0
+    for record_id in args.ids:
+        if remove_record(args.kind, record_id):
+            print(f"Deleted {args.kind} record {record_id}.")
+        else:
+            print(f"No {args.kind} record with ID {record_id}.", file=sys.stderr)
+            status = 1
+    return status
+
+def cmd_serve(args) -> int:
+    try:
+        serve_api(args.host, args.port, args.readers)
+    except OSError as e:
+        print(f"Could not start the server: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+# Run commands read from stdin (one per line, shell quoting) inside a single transaction.
+# Any failing line (exit status other than 0 or NO_MATCH) rolls the whole batch back; a search
+# that finds nothing is not a failure.
+def cmd_batch(args) -> int:
+    parser = build_parser()
+    count = 0
+    try:
+        with transaction():
+            for line_no, line in enumerate(sys.stdin, start=1):
+                words = shlex.split(line, comments=True)
+                if not words:
+                    continue
+                try:
+                    command = parser.parse_args(words)
+                except SystemExit:
+                    raise ValueError(f"line {line_no}: invalid command")
+                if command.command in (None, "batch", "serve"):
+                    raise ValueError(f"line {line_no}: not allowed in a batch")
+                if command.func(command) not in (0, NO_MATCH):
+                    raise ValueError(f"line {line_no}: '{line.strip()}' failed")
+                count += 1
+    except ValueError as e:
+        print(f"Batch aborted, nothing was saved: {e}", file=sys.stderr)
+        return 1
+    print(f"{count} commands committed.", file=sys.stderr)
+    return 0
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="port-3.py", description="SiSh Tracker. Run without a command for the interactive menu.")
+    parser.add_argument("--db", default=DB_PATH, help=f"database file (default: {DB_PATH})")
+    parser.add_argument("--user", help="log in as this user; the password comes from $TRACKER_PASSWORD or a prompt")
+    parser.add_argument("--read-only", action="store_true",
+                        help="open the database read-only, for searches and reports alongside a running writer")
+    sub = parser.add_subparsers(dest="command", metavar="command")
+    kinds = list(RECORD_TABLES)
+
+    p = sub.add_parser("register", help="create a user account")
+    p.add_argument("username")
+    p.set_defaults(func=cmd_register)
+
+    p = sub.add_parser("role", help="make a user an admin, or a regular user again (admins only)")
+    p.add_argument("username")
+    p.add_argument("role", choices=["admin", "user"])
+    p.set_defaults(func=cmd_role)
+
+    p = sub.add_parser("add", help="add one record")
+    p.add_argument("kind", choices=kinds)
+    p.add_argument("amount", type=int)
+    p.add_argument("category")
+    p.add_argument("date", help="YYYY-MM-DD")
+    p.add_argument("--create-category", action="store_true", help="create the category if it doesn't exist")
+    p.add_argument("--ref", help="external reference (e.g. a bank transaction id) that tells apart otherwise identical records")
+    p.add_argument("--note", help="free-text note, searchable with 'find'")
+    p.set_defaults(func=cmd_add)
+
+    p = sub.add_parser("import", help="bulk import a CSV or JSON-lines file")
+    p.add_argument("kind", choices=kinds)
+    p.add_argument("path")
+    p.set_defaults(func=cmd_import)
+
+    p = sub.add_parser("search", help="search records (exit status 3 when nothing matches)")
+    p.add_argument("kind", choices=kinds)
+    p.add_argument("--amount", type=int)
+    p.add_argument("--min", type=int, help="minimum amount")
+    p.add_argument("--max", type=int, help="maximum amount")
+    p.add_argument("--category")
+    p.add_argument("--date", help="exact date")
+    p.add_argument("--from", dest="date_from")
+    p.add_argument("--to", dest="date_to")
+    p.add_argument("--during", metavar="PERIOD", help="a year (2024), quarter (2024-Q2) or month (2024-06)")
+    p.add_argument("--sort", choices=list(SORT_ORDERS), default="id", help="result order (default: id)")
+    p.add_argument("--limit", type=int, help="stop after this many records (with --sort amount_desc: the top N)")
+    p.add_argument("--json", action="store_true", help="print JSON lines instead of CSV")
+    p.set_defaults(func=cmd_search)
+
+    p = sub.add_parser("find", help="full-text search of notes and category names (exit status 3 when nothing matches)")
+    p.add_argument("kind", choices=kinds)
+    p.add_argument("text", help="words to find; each matches as a prefix")
+    p.add_argument("--fuzzy", action="store_true", help="also match words spelled slightly differently")
+    p.add_argument("--limit", type=int, default=PAGE_SIZE)
+    p.add_argument("--json", action="store_true", help="print JSON lines instead of CSV")
+    p.set_defaults(func=cmd_find)
+
+    p = sub.add_parser("report", help="print totals and summary reports")
+    p.add_argument("report", choices=["totals", "monthly", "weekly", "net", "top", "check"])
+    p.add_argument("--kind", choices=kinds, default="expense")
+    p.add_argument("--period", choices=list(PERIOD_FORMATS), default="month", help="period for 'net'")
+    p.add_argument("--limit", type=int, default=5, help="number of categories for 'top'")
+    p.add_argument("--from", dest="date_from")
+    p.add_argument("--to", dest="date_to")
+    p.add_argument("--during", metavar="PERIOD", help="a year (2024), quarter (2024-Q2) or month (2024-06)")
+    p.add_argument("--repair", action="store_true", help="rebuild totals if 'check' finds a mismatch")
+    p.add_argument("--json", action="store_true", help="print JSON lines instead of CSV")
+    p.set_defaults(func=cmd_report)
+
+    p = sub.add_parser("export", help="export records to CSV or Parquet")
+    p.add_argument("target", choices=kinds + ["totals", "parquet", "reports"])
+    p.add_argument("path", help="output file (a directory for parquet and reports)")
+    p.add_argument("--from", dest="date_from")
+    p.add_argument("--to", dest="date_to")
+    p.add_argument("--gzip", action="store_true", help="gzip the CSV (implied by a .gz path)")
+    p.add_argument("--full", action="store_true", help="parquet: full snapshot instead of incremental")
+    p.add_argument("--workers", type=int, help="reports: worker processes (default: one per CPU)")
+    p.add_argument("--all-users", action="store_true", help="reports: every user's, not just yours (admins only)")
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser("delete", help="delete records by ID")
+    p.add_argument("kind", choices=kinds)
+    p.add_argument("ids", type=int, nargs="+")
+    p.set_defaults(func=cmd_delete)
+
+    p = sub.add_parser("rules", help="recurring records: add, list, delete, or write the ones due")
+    rules = p.add_subparsers(dest="action", metavar="action", required=True)
+    p = rules.add_parser("add", help="add a recurring record")
+    p.add_argument("kind", choices=kinds)
+    p.add_argument("amount", type=int)
+    p.add_argument("category")
+    p.add_argument("cadence", help=f"{', '.join(CADENCES)}, or a cron day pattern such as '1,15 * *'")
+    p.add_argument("start", help="first occurrence, YYYY-MM-DD")
+    p.add_argument("--end", help="last possible date")
+    p.add_argument("--note")
+    p.add_argument("--create-category", action="store_true", help="create the category if it doesn't exist")
+    p.set_defaults(func=cmd_rules_add)
+    p = rules.add_parser("list", help="list your recurring records")
+    p.add_argument("--json", action="store_true", help="print JSON lines instead of CSV")
+    p.set_defaults(func=cmd_rules_list)
+    p = rules.add_parser("delete", help="delete rules by ID (records already written stay)")
+    p.add_argument("ids", type=int, nargs="+")
+    p.set_defaults(func=cmd_rules_delete)
+    p = rules.add_parser("run", help="write the occurrences due, in one transaction; safe to rerun (e.g. from cron)")
+    p.add_argument("--through", metavar="DATE", help="write occurrences up to this date (default: today)")
+    p.add_argument("--all-users", action="store_true", help="every user's rules, not just yours (admins only)")
+    p.set_defaults(func=cmd_rules_run)
+
+    p = sub.add_parser("dedupe", help="remove duplicate records")
+    p.add_argument("kind", nargs="?", choices=kinds)
+    p.add_argument("--all-users", action="store_true", help="every user's records, not just yours (admins only)")
+    p.set_defaults(func=cmd_dedupe)
+
+    p = sub.add_parser("batch", help="run commands from stdin in one transaction")
+    p.set_defaults(func=cmd_batch)
+
+    p = sub.add_parser("serve", help="serve the HTTP JSON API (log in with POST /login)")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8000)
+    p.add_argument("--readers", type=int, default=API_READERS, help="pooled read-only connections")
+    p.set_defaults(func=cmd_serve)
+    return parser
+
+def main(argv: Optional[List[str]] = None) -> int:
+    global DB_PATH, READ_ONLY
+    args = build_parser().parse_args(argv)
+    DB_PATH = args.db
+    READ_ONLY = args.read_only
+    if READ_ONLY and args.command not in (None,) + READ_ONLY_COMMANDS:
+        print(f"'{args.command}' changes the database; read-only sessions can run: "
+              f"{', '.join(READ_ONLY_COMMANDS)}.", file=sys.stderr)
+        return 2
+    try:
+        init_db()
+        if args.command is None:
+            run_interactive()
+            return 0
+        if args.command not in ("register", "serve"):
+            if args.user:
+                user_id = verify_credentials(args.user, cli_password())
+                if user_id is None:
+                    print("Authentication failed.", file=sys.stderr)
+                    return 1
+            elif has_users():
+                print("--user is required once accounts exist.", file=sys.stderr)
+                return 2
+            else:
+                user_id = 1  # Single-user database from before accounts existed
+            set_current_user(user_id)
+        return args.func(args)
+    except PermissionError as e:
+        print(e, file=sys.stderr)
+        return 1
+    except sqlite3.Error as e:
+        print(f"Database error: {e}", file=sys.stderr)
+        return 1
 
 # Start the application
-load_incat()
-load_categories()
-load_expenses()
-load_income()
-while True: 
-    welcome()
-    choices()
-    while True:
-        mainmenu = input("Return to main menu? (y/n) \n")
-        if mainmenu.lower().strip() == "n":
-            print("Exiting the program...")
-            print("See ya.")
-            exit()
-        elif mainmenu.lower().strip() == "y":
-            break
-        else:
-            print("Invalid input, try again.")
-
-
-
-
+if __name__ == "__main__":
+    sys.exit(main())